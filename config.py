@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+
 from easydict import EasyDict
 
 cfg = EasyDict()
@@ -20,6 +22,12 @@ cfg.faulty_layers = []
 # cfg.faulty_layers = ['linear']
 cfg.faulty_layers = ["linear", "conv"]
 
+# Fault aware training against a pool of precomputed fault maps: a
+# (ber, seed) entry is sampled per batch. Size 0 trains with a single map.
+cfg.fault_pool_size = 0
+cfg.fault_pool_bers = []  # empty: use the bit error rate of the run
+cfg.fault_pool_refresh = 0  # epochs between pool regenerations (0: never)
+
 cfg.batch_size = 128
 cfg.test_batch_size = 100
 cfg.epochs = 5
@@ -31,6 +39,50 @@ cfg.data_dir = (
 cfg.save_dir = (
     "/gpfs/u/barn/RAIM/RAIMrmnb/energy-efficient-resilience-work-dir"
 )
+# Do not download nor verify the data sets, just check their presence
+cfg.offline = False
+# "torchvision" or "tensor" (pre-decoded uint8 cache under data_dir)
+cfg.data_backend = "torchvision"
+# Shape ("cifar10" or "mnist") and number of images per split of the
+# synthetic data set
+cfg.synthetic_shape = "cifar10"
+cfg.synthetic_size = 10000
+# Evaluate on a class-stratified subset of the test set of eval_samples
+# images or eval_fraction of the set (0: whole test set)
+cfg.eval_samples = 0
+cfg.eval_fraction = 0
+# DataLoader options (None: derived from the number of CPUs and the device)
+cfg.num_workers = None
+cfg.pin_memory = None
+cfg.persistent_workers = None
+cfg.prefetch_factor = None
+
+# torch.compile execution mode (--compile)
+cfg.compile = False
+cfg.compile_cache_dir = os.path.join(cfg.save_dir, "torch_compile_cache")
+# Use torch.channels_last for models and inputs (--channels-last)
+cfg.channels_last = False
+
+# Instrumentation hooks (see zs_hooks_stats.HookManager): global switch
+# and sampling (every Nth batch, first K batches (0: all), random fraction)
+cfg.hooks_enabled = True
+cfg.hook_every = 1
+cfg.hook_first = 0
+cfg.hook_fraction = 1.0
+# Streaming histograms (see zs_hooks_stats.HistogramCollector): bins per
+# histogram and log2 magnitude bins instead of linear ones
+cfg.histogram_bins = 2048
+cfg.histogram_log = False
+
+# Hardware energy models (see energymodels and zs_energy_estimation):
+# the estimates are scored against all of them
+cfg.energy_models = [
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "energymodels",
+        "power10_mma.json",
+    )
+]
 
 cfg.temperature = 1
 cfg.channels = 3
@@ -46,5 +98,6 @@ cfg.decay = 0.96
 cfg.max_epoch = 1
 cfg.lb = 1
 cfg.seed = 0
+cfg.log_every = 0  # batches between training progress reports (0: none)
 
 cfg.device = None
@@ -22,6 +22,7 @@ custom autograd function and extend the nn.Linear class
 https://pytorch.org/docs/stable/_modules/torch/nn/modules/linear.html
 """
 
+import contextlib
 import math
 
 import torch
@@ -35,6 +36,16 @@ from torch.nn.modules.utils import _pair
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 dtype = torch.float32
 
+# Context manager factory (module, op name) wrapped around the fault ops
+# of the layers (fault map generation and injection). Set by zs_profile.
+fault_op_context = None
+
+
+def faultOp(module, name):
+    if fault_op_context is None:
+        return contextlib.nullcontext()
+    return fault_op_context(module, name)
+
 
 class FaultInject(torch.autograd.Function):
     """
@@ -97,6 +108,101 @@ class FaultInject(torch.autograd.Function):
         return grad_output, None, None, None, None
 
 
+def genFaultMap(
+    BitErrorMap_flip0to1, BitErrorMap_flip1to0, precision, weights
+):
+    """
+    Map the bit error maps of the memory array to the weights.
+    Every precision consecutive bits of a memory row are packed into one
+    weight mask, and the packed array is tiled over the weights.
+    Only tensor operations on static shapes are used, so that the mapping
+    can be traced by torch.compile.
+    """
+
+    # Reshaping bit error map to map weights
+    BitErrorMap0to1 = packFaultMap(BitErrorMap_flip0to1, precision)
+    BitErrorMap1to0 = packFaultMap(BitErrorMap_flip1to0, precision)
+
+    return tileFaultMap(BitErrorMap0to1, BitErrorMap1to0, weights)
+
+
+def packFaultMap(BitErrorMap_flip, precision):
+    """
+    Pack every precision bits of each memory row into an uint8 mask
+    (bit j of weight k is stored in column k * precision + j).
+    Returns a (memory rows, weights per row) tensor.
+    """
+    rows = BitErrorMap_flip.shape[0]
+    weights_per_row = (int)(BitErrorMap_flip.shape[1] / precision)
+    shifts = torch.arange(
+        precision, dtype=BitErrorMap_flip.dtype, device=BitErrorMap_flip.device
+    )
+    bits = BitErrorMap_flip[:, 0 : weights_per_row * precision].reshape(
+        rows, weights_per_row, precision
+    )
+    return torch.sum(bits << shifts, dim=2).to(torch.uint8)
+
+
+def tileFaultMap(BitErrorMap0to1, BitErrorMap1to0, weights):
+    """
+    Tile the packed fault maps (see packFaultMap) over the weights.
+    """
+
+    numweights = torch.numel(weights)
+    mem_array_rows = BitErrorMap0to1.shape[0]
+    weights_per_row = BitErrorMap0to1.shape[1]
+
+    # The memory array is tiled weights_per_row times along the columns
+    # and as many times as needed (banks) along the rows. Only the banks
+    # covering the weights are materialized.
+    bank_size = mem_array_rows * weights_per_row * weights_per_row
+    num_banks = math.ceil(numweights / bank_size)
+    BitErrorMap0to1 = torch.tile(BitErrorMap0to1, (num_banks, weights_per_row))
+    # invert this one, since it needs to be And-ed
+    BitErrorMap1to0 = torch.tile(
+        ~BitErrorMap1to0, (num_banks, weights_per_row)
+    )
+
+    # This mapping is highly dependent on data flow
+    BitErrorMap0to1 = BitErrorMap0to1.view(-1)[0:numweights]
+    BitErrorMap1to0 = BitErrorMap1to0.view(-1)[0:numweights]
+
+    BitErrorMap0to1 = torch.reshape(BitErrorMap0to1, weights.size())
+    BitErrorMap1to0 = torch.reshape(BitErrorMap1to0, weights.size())
+
+    # Faults are always assigned following the logical (NCHW) order of the
+    # weights. For channels last weights only the layout of the maps is
+    # changed (not which element each mask goes to), so that the bitwise
+    # ops in FaultInject keep the memory format of the weights.
+    if weights.dim() == 4 and not weights.is_contiguous():
+        if weights.is_contiguous(memory_format=torch.channels_last):
+            BitErrorMap0to1 = BitErrorMap0to1.contiguous(
+                memory_format=torch.channels_last
+            )
+            BitErrorMap1to0 = BitErrorMap1to0.contiguous(
+                memory_format=torch.channels_last
+            )
+
+    return BitErrorMap0to1, BitErrorMap1to0
+
+
+def poolFaultMap(layer, weights):
+    """
+    Return the fault maps of the weights of a layer using the fault map
+    pool (see faultmodels.faultpool): the cached tiled maps when they
+    match the shape and memory format of the weights, else the packed
+    maps tiled over the weights.
+    """
+    tiled = layer.TiledBitErrorMaps
+    if (
+        tiled is not None
+        and tiled[0].shape == weights.shape
+        and tiled[0].stride() == weights.stride()
+    ):
+        return tiled
+    return tileFaultMap(*layer.PackedBitErrorMaps, weights)
+
+
 class nnLinearPerturbWeight(nn.Linear):
     """Applies a linear transformation to the incoming data: y = xA^T + b
     Along with the linear transform, the learnable weights are quantized,
@@ -127,24 +233,30 @@ class nnLinearPerturbWeight(nn.Linear):
         self.clamp_val = clamp_val
         self.BitErrorMap0 = BitErrorMap0to1
         self.BitErrorMap1 = BitErrorMap1to0
+        # Already packed (0to1, 1to0) maps that override the bit error maps,
+        # and the same maps tiled over the weights (see faultmodels.faultpool)
+        self.PackedBitErrorMaps = None
+        self.TiledBitErrorMaps = None
         self.reset_parameters()
 
     def forward(self, input):
         if self.precision > 0:
-            BitErrorMap0to1, BitErrorMap1to0 = self.genFaultMap(
-                self.BitErrorMap0,
-                self.BitErrorMap1,
-                self.precision,
-                self.weight,
-            )
+            with faultOp(self, "fault_map"):
+                BitErrorMap0to1, BitErrorMap1to0 = self.genFaultMap(
+                    self.BitErrorMap0,
+                    self.BitErrorMap1,
+                    self.precision,
+                    self.weight,
+                )
             perturbweight = FaultInject.apply
-            perturbed_weights = perturbweight(
-                self.weight,
-                self.precision,
-                self.clamp_val,
-                BitErrorMap0to1,
-                BitErrorMap1to0,
-            )
+            with faultOp(self, "fault_inject"):
+                perturbed_weights = perturbweight(
+                    self.weight,
+                    self.precision,
+                    self.clamp_val,
+                    BitErrorMap0to1,
+                    BitErrorMap1to0,
+                )
         return F.linear(input, perturbed_weights, self.bias)
 
     def extra_repr(self) -> str:
@@ -158,46 +270,11 @@ class nnLinearPerturbWeight(nn.Linear):
     def genFaultMap(
         self, BitErrorMap_flip0to1, BitErrorMap_flip1to0, precision, weights
     ):
-
-        numweights = torch.numel(weights)
-
-        mem_array_rows = BitErrorMap_flip0to1.shape[0]
-        mem_array_cols = BitErrorMap_flip0to1.shape[1]
-
-        weights_per_row = (int)(mem_array_cols / precision)
-
-        BitErrorMap0to1 = torch.zeros(
-            (mem_array_rows, weights_per_row), dtype=torch.uint8
-        ).to(device)
-        BitErrorMap1to0 = torch.zeros(
-            (mem_array_rows, weights_per_row), dtype=torch.uint8
-        ).to(device)
-
-        # Reshaping bit error map to map weights
-        for k in range(0, weights_per_row):
-            for j in range(0, precision):
-                BitErrorMap0to1[:, k] += (
-                    BitErrorMap_flip0to1[:, k * precision + j] << j
-                )
-                BitErrorMap1to0[:, k] += (
-                    BitErrorMap_flip1to0[:, k * precision + j] << j
-                )
-
-        rows = math.ceil(numweights / weights_per_row)
-        cols = weights_per_row
-        num_banks = math.ceil(rows / mem_array_rows)
-        BitErrorMap0to1 = torch.tile(BitErrorMap0to1, (num_banks, cols))
-        # invert this one, since it needs to be And-ed
-        BitErrorMap1to0 = torch.tile(~BitErrorMap1to0, (num_banks, cols))
-
-        # This mapping is highly dependent on data flow
-        BitErrorMap0to1 = BitErrorMap0to1.view(-1)[0:numweights]
-        BitErrorMap1to0 = BitErrorMap1to0.view(-1)[0:numweights]
-
-        BitErrorMap0to1 = torch.reshape(BitErrorMap0to1, weights.size())
-        BitErrorMap1to0 = torch.reshape(BitErrorMap1to0, weights.size())
-
-        return BitErrorMap0to1, BitErrorMap1to0
+        if self.PackedBitErrorMaps is not None:
+            return poolFaultMap(self, weights)
+        return genFaultMap(
+            BitErrorMap_flip0to1, BitErrorMap_flip1to0, precision, weights
+        )
 
 
 def nnLinearPerturbWeight_op(
@@ -260,23 +337,29 @@ class nnConv2dPerturbWeight(nn.Conv2d):
         self.clamp_val = clamp_val
         self.BitErrorMap0 = BitErrorMap0to1
         self.BitErrorMap1 = BitErrorMap1to0
+        # Already packed (0to1, 1to0) maps that override the bit error maps,
+        # and the same maps tiled over the weights (see faultmodels.faultpool)
+        self.PackedBitErrorMaps = None
+        self.TiledBitErrorMaps = None
 
     def forward(self, input):
         if self.precision > 0:
-            BitErrorMap0to1, BitErrorMap1to0 = self.genFaultMap(
-                self.BitErrorMap0,
-                self.BitErrorMap1,
-                self.precision,
-                self.weight,
-            )
+            with faultOp(self, "fault_map"):
+                BitErrorMap0to1, BitErrorMap1to0 = self.genFaultMap(
+                    self.BitErrorMap0,
+                    self.BitErrorMap1,
+                    self.precision,
+                    self.weight,
+                )
             perturbweight = FaultInject.apply
-            perturbed_weights = perturbweight(
-                self.weight,
-                self.precision,
-                self.clamp_val,
-                BitErrorMap0to1,
-                BitErrorMap1to0,
-            )
+            with faultOp(self, "fault_inject"):
+                perturbed_weights = perturbweight(
+                    self.weight,
+                    self.precision,
+                    self.clamp_val,
+                    BitErrorMap0to1,
+                    BitErrorMap1to0,
+                )
         return F.conv2d(
             input,
             perturbed_weights,
@@ -290,45 +373,11 @@ class nnConv2dPerturbWeight(nn.Conv2d):
     def genFaultMap(
         self, BitErrorMap_flip0to1, BitErrorMap_flip1to0, precision, weights
     ):
-
-        numweights = torch.numel(weights)
-        mem_array_rows = BitErrorMap_flip0to1.shape[0]
-        mem_array_cols = BitErrorMap_flip0to1.shape[1]
-
-        weights_per_row = (int)(mem_array_cols / precision)
-
-        BitErrorMap0to1 = torch.zeros(
-            (mem_array_rows, weights_per_row), dtype=torch.uint8
-        ).to(device)
-        BitErrorMap1to0 = torch.zeros(
-            (mem_array_rows, weights_per_row), dtype=torch.uint8
-        ).to(device)
-
-        # Reshaping bit error map to map weights
-        for k in range(0, weights_per_row):
-            for j in range(0, precision):
-                BitErrorMap0to1[:, k] += (
-                    BitErrorMap_flip0to1[:, k * precision + j] << j
-                )
-                BitErrorMap1to0[:, k] += (
-                    BitErrorMap_flip1to0[:, k * precision + j] << j
-                )
-
-        rows = math.ceil(numweights / weights_per_row)
-        cols = weights_per_row
-        num_banks = math.ceil(rows / mem_array_rows)
-        BitErrorMap0to1 = torch.tile(BitErrorMap0to1, (num_banks, cols))
-        # invert this one, since it needs to be And-ed
-        BitErrorMap1to0 = torch.tile(~BitErrorMap1to0, (num_banks, cols))
-
-        # This mapping is highly dependent on data flow
-        BitErrorMap0to1 = BitErrorMap0to1.view(-1)[0:numweights]
-        BitErrorMap1to0 = BitErrorMap1to0.view(-1)[0:numweights]
-
-        BitErrorMap0to1 = torch.reshape(BitErrorMap0to1, weights.size())
-        BitErrorMap1to0 = torch.reshape(BitErrorMap1to0, weights.size())
-
-        return BitErrorMap0to1, BitErrorMap1to0
+        if self.PackedBitErrorMaps is not None:
+            return poolFaultMap(self, weights)
+        return genFaultMap(
+            BitErrorMap_flip0to1, BitErrorMap_flip1to0, precision, weights
+        )
 
 
 def nnConv2dPerturbWeight_op(
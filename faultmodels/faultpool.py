@@ -0,0 +1,137 @@
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+
+from faultinjection_ops.zs_faultinjection_ops import (
+    packFaultMap,
+    tileFaultMap,
+)
+from faultmodels import randomfault
+
+# Pool of precomputed fault maps for fault aware training.
+# Every entry is a (ber, seed) pair whose RandomFaultModel bit error maps
+# are stored packed (one uint8 mask per weight, see packFaultMap) on the
+# target device. Once attached to a model, the maps of every entry are
+# also tiled over the weights of each fault injection layer (in the shape
+# and memory format of its weights, 2 bytes per weight and entry), so that
+# swapping the maps of a model is just pointing its fault injection layers
+# to another entry of the pool, with no per step tiling.
+
+
+class FaultMapPool:
+    def __init__(self, bers, size, precision, position, device, seed=0):
+        """
+        :param bers: A list of floats. Bit error rates of the pool entries
+                     (assigned round robin).
+        :param size: An int. The number of fault maps in the pool.
+        :param precision: An int. The number of bits of the weights.
+        :param position: An int. Position of the bit errors (-1: any).
+        :param device: The device where the packed maps are stored.
+        :param seed: An int. Seed of the first entry of the pool.
+        """
+        self.bers = list(bers)
+        self.size = size
+        self.precision = precision
+        self.position = position
+        self.device = device
+        self.layers = []
+        self.tiled = {}
+        self.entries = []
+        self.current = None
+        self.generator = torch.Generator().manual_seed(seed)
+        self.generate(seed)
+
+    def generate(self, seed):
+        """
+        (Re)generate all the entries of the pool starting at seed.
+        """
+        print(
+            "Generating fault map pool of %d maps (BERs %s, seed %d)"
+            % (self.size, self.bers, seed)
+        )
+        entries = []
+        maps0to1 = []
+        maps1to0 = []
+        for i in range(self.size):
+            ber = self.bers[i % len(self.bers)]
+            # A fault map uses seed and seed + 1 (see RandomFaultModel)
+            entry_seed = seed + 2 * i
+            rf = randomfault.RandomFaultModel(
+                ber, self.precision, self.position, entry_seed
+            )
+            for bitmap, maps in (
+                (rf.BitErrorMap_flip0, maps0to1),
+                (rf.BitErrorMap_flip1, maps1to0),
+            ):
+                bitmap = torch.tensor(bitmap).to(torch.int32).to(self.device)
+                maps.append(packFaultMap(bitmap, self.precision))
+            entries.append((ber, entry_seed))
+
+        self.entries = entries
+        self.maps0to1 = torch.stack(maps0to1)
+        self.maps1to0 = torch.stack(maps1to0)
+        self.tile()
+        if self.current is not None:
+            self.select(self.current)
+
+    def tile(self):
+        """
+        Cache the maps of every entry tiled over the weights of the
+        attached layers.
+        """
+        self.tiled = {
+            layer: [
+                tileFaultMap(
+                    self.maps0to1[index], self.maps1to0[index], layer.weight
+                )
+                for index in range(self.size)
+            ]
+            for layer in self.layers
+        }
+
+    def attach(self, model):
+        """
+        Use the pool maps for all the fault injection layers of model.
+        """
+        self.layers = [
+            module
+            for module in model.modules()
+            if hasattr(module, "PackedBitErrorMaps")
+        ]
+        self.tile()
+        self.select(0)
+
+    def detach(self):
+        for layer in self.layers:
+            layer.PackedBitErrorMaps = None
+            layer.TiledBitErrorMaps = None
+        self.layers = []
+        self.tiled = {}
+        self.current = None
+
+    def select(self, index):
+        maps = (self.maps0to1[index], self.maps1to0[index])
+        for layer in self.layers:
+            layer.PackedBitErrorMaps = maps
+            layer.TiledBitErrorMaps = self.tiled[layer][index]
+        self.current = index
+
+    def sample(self):
+        """
+        Select a random entry of the pool. Returns its (ber, seed) pair.
+        """
+        index = int(torch.randint(self.size, (1,), generator=self.generator))
+        self.select(index)
+        return self.entries[index]
@@ -54,7 +54,7 @@ class RandomFaultModel:
             (
                 self.BitErrorMap_flip0,
                 self.BitErrorMap_flip1,
-            ) = self.GenBitPositionErrorMap(pos)
+            ) = self.GenBitPositionErrorMap(pos, seed)
 
     def GenBitErrorMap(self, seed):
         bitmap = np.zeros((self.MEM_ROWS, self.MEM_COLS))
@@ -87,7 +87,7 @@ class RandomFaultModel:
         print("Read 1 Bit Error Rate", sum(sum(bitmap_flip1)) / bitcells)
         return bitmap_flip0, bitmap_flip1
 
-    def GenBitPositionErrorMap(self, pos):
+    def GenBitPositionErrorMap(self, pos, seed=None):
 
         bitmap = np.zeros((self.MEM_ROWS, self.MEM_COLS))
         bitmap_flip0 = np.zeros((self.MEM_ROWS, self.MEM_COLS))
@@ -97,6 +97,8 @@ class RandomFaultModel:
         # maximum of one error per weight in the specified position
         weights_per_row = int(self.MEM_COLS / self.precision)
         bitmap_pos = np.zeros((self.MEM_ROWS, weights_per_row))
+        if seed is not None:
+            np.random.seed(seed)
         bitmap_t = np.random.rand(self.MEM_ROWS, weights_per_row)
         bitmap_pos[bitmap_t < self.ber] = 1
         # Insert the faulty column in bit error map
@@ -104,6 +106,8 @@ class RandomFaultModel:
             bitmap[:, k * self.precision + pos] = bitmap_pos[:, k]
         # print(bitmap)
 
+        if seed is not None:
+            np.random.seed(seed + 1)
         bitmap_flip = np.random.rand(self.MEM_ROWS, self.MEM_COLS)
         bitmap_flip0[bitmap_flip < self.ber0] = 1
         bitmap_flip1[bitmap_flip >= self.ber0] = 1
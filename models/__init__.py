@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import inspect
 import os
+import pickle
 
 import torch
 
@@ -28,7 +30,9 @@ from .vgg import vgg  # noqa: F401
 from .vggf import vggf  # noqa: F401
 
 
-def init_models(arch, in_channels, precision, retrain, checkpoint_path):
+def init_models(
+    arch, in_channels, precision, retrain, checkpoint_path, model_only=False
+):
 
     """
     Default model loader
@@ -49,24 +53,9 @@ def init_models(arch, in_channels, precision, retrain, checkpoint_path):
     checkpoint_epoch = -1
 
     if retrain:
-        if not os.path.exists(checkpoint_path):
-            for x in range(cfg.epochs, -1, -1):
-                if os.path.exists(model_path_from_base(checkpoint_path, x)):
-                    checkpoint_path = model_path_from_base(checkpoint_path, x)
-                    break
-
-        if not os.path.exists(checkpoint_path):
-            print("Checkpoint path not exists")
-            return model, checkpoint_epoch
-
-        print("Restoring model from checkpoint", checkpoint_path)
-        checkpoint = torch.load(checkpoint_path)
-
-        model.load_state_dict(checkpoint["model_state_dict"])
-        print("restored checkpoint at epoch - ", checkpoint["epoch"])
-        print("Training loss =", checkpoint["loss"])
-        print("Training accuracy =", checkpoint["accuracy"])
-        checkpoint_epoch = checkpoint["epoch"]
+        checkpoint_epoch = restore_checkpoint(
+            model, checkpoint_path, model_only
+        )
 
     return model, checkpoint_epoch
 
@@ -81,6 +70,7 @@ def init_models_faulty(
     bit_error_rate,
     position,
     seed=0,
+    model_only=False,
 ):
 
     """
@@ -89,7 +79,12 @@ def init_models_faulty(
 
     if not cfg.faulty_layers or len(cfg.faulty_layers) == 0:
         return init_models(
-            arch, in_channels, precision, retrain, checkpoint_path
+            arch,
+            in_channels,
+            precision,
+            retrain,
+            checkpoint_path,
+            model_only=model_only,
         )
     else:
         """Perturbed models, where the weights are injected with bit
@@ -167,24 +162,9 @@ def init_models_faulty(
     checkpoint_epoch = -1
 
     if retrain:
-        if not os.path.exists(checkpoint_path):
-            for x in range(cfg.epochs, -1, -1):
-                if os.path.exists(model_path_from_base(checkpoint_path, x)):
-                    checkpoint_path = model_path_from_base(checkpoint_path, x)
-                    break
-
-        if not os.path.exists(checkpoint_path):
-            print("Checkpoint path not exists")
-            return model, checkpoint_epoch
-
-        print("Restoring model from checkpoint", checkpoint_path)
-        checkpoint = torch.load(checkpoint_path)
-
-        model.load_state_dict(checkpoint["model_state_dict"])
-        print("restored checkpoint at epoch - ", checkpoint["epoch"])
-        print("Training loss =", checkpoint["loss"])
-        print("Training accuracy =", checkpoint["accuracy"])
-        checkpoint_epoch = checkpoint["epoch"]
+        checkpoint_epoch = restore_checkpoint(
+            model, checkpoint_path, model_only
+        )
 
     return model, checkpoint_epoch
 
@@ -199,12 +179,18 @@ def init_models_pairs(
     bit_error_rate,
     position,
     seed=0,
+    model_only=False,
 ):
 
     """Load the default model as well as the corresponding perturbed model"""
 
     model, checkpoint_epoch = init_models(
-        arch, in_channels, precision, retrain, checkpoint_path[0]
+        arch,
+        in_channels,
+        precision,
+        retrain,
+        checkpoint_path[0],
+        model_only=model_only,
     )
     model_p, checkpoint_epoch_p = init_models_faulty(
         arch,
@@ -216,11 +202,121 @@ def init_models_pairs(
         bit_error_rate,
         position,
         seed=seed,
+        model_only=model_only,
     )
 
     return model, checkpoint_epoch, model_p, checkpoint_epoch_p
 
 
+def load_checkpoint(checkpoint_path, device=None, model_only=False):
+    """
+    Load a checkpoint straight into the target device.
+    Memory-mapped and weights-only reads are used when the installed
+    pytorch supports them, so that tensors which are not needed (e.g. the
+    optimizer state) are never read from disk.
+    :param checkpoint_path: A string. The path of the checkpoint.
+    :param device: The device where the tensors are mapped to. Defaults to
+                   cfg.device (or CPU if not set).
+    :param model_only: A boolean. Drop everything but the model state and
+                       the training summary (eval/transform modes).
+    """
+
+    if device is None:
+        device = cfg.device if cfg.device is not None else "cpu"
+
+    load_args = {"map_location": device}
+    load_params = inspect.signature(torch.load).parameters
+    if "mmap" in load_params:
+        load_args["mmap"] = True
+    if "weights_only" in load_params:
+        load_args["weights_only"] = True
+
+    try:
+        checkpoint = torch.load(checkpoint_path, **load_args)
+    except (RuntimeError, pickle.UnpicklingError):
+        # Legacy (non-zipfile) checkpoints can not be memory-mapped and
+        # old ones might pickle objects other than tensors.
+        load_args.pop("mmap", None)
+        load_args.pop("weights_only", None)
+        checkpoint = torch.load(checkpoint_path, **load_args)
+
+    if model_only:
+        checkpoint.pop("optimizer_state_dict", None)
+
+    return checkpoint
+
+
+def memory_format():
+
+    """
+    Memory format used for the models and the input batches.
+    """
+
+    if cfg.channels_last:
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+def compile_model(model, cache_dir=None):
+
+    """
+    Run the model through torch.compile (pytorch >= 2.0), keeping the
+    compiled artifacts in cache_dir so they are reused across runs.
+    The returned module shares parameters with model; use the original
+    model for state_dict() so checkpoint keys do not change.
+    """
+
+    if not hasattr(torch, "compile"):
+        print("torch.compile not available, running in eager mode")
+        return model
+
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+    print("Compiling model (cache: %s)" % cache_dir)
+    return torch.compile(model)
+
+
+def find_checkpoint(checkpoint_path):
+    """
+    Return checkpoint_path if it exists, or the latest epoch checkpoint if
+    checkpoint_path is a base name. None if not found.
+    """
+
+    if os.path.exists(checkpoint_path):
+        return checkpoint_path
+    for x in range(cfg.epochs, -1, -1):
+        if os.path.exists(model_path_from_base(checkpoint_path, x)):
+            return model_path_from_base(checkpoint_path, x)
+    return None
+
+
+def restore_checkpoint(model, checkpoint_path, model_only=False):
+    """
+    Restore the model state from checkpoint_path (or from the latest epoch
+    checkpoint if checkpoint_path is a base name).
+    Returns the epoch of the checkpoint or -1 if not found.
+    """
+
+    checkpoint_path = find_checkpoint(checkpoint_path)
+    if checkpoint_path is None:
+        print("Checkpoint path not exists")
+        return -1
+
+    print("Restoring model from checkpoint", checkpoint_path)
+    checkpoint = load_checkpoint(checkpoint_path, model_only=model_only)
+
+    model.load_state_dict(checkpoint["model_state_dict"])
+    print("restored checkpoint at epoch - ", checkpoint["epoch"])
+    print("Training loss =", checkpoint["loss"])
+    print("Training accuracy =", checkpoint["accuracy"])
+
+    return checkpoint["epoch"]
+
+
 def default_base_model_path(data_dir, arch, dataset, precision, fl, ber, pos):
     extra = [arch, dataset, "p", str(precision), "model"]
     if len(fl) != 0:
@@ -0,0 +1,45 @@
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+from faultmodels.randomfault import RandomFaultModel
+
+
+def maps(seed, position):
+    rf = RandomFaultModel(0.01, 8, position, seed)
+    return rf.BitErrorMap_flip0, rf.BitErrorMap_flip1
+
+
+@pytest.mark.parametrize("position", [-1, 3])
+def test_seed_identifies_map(position):
+    # The global numpy state must not leak into the map (as in forked
+    # campaign workers that inherit it)
+    np.random.seed(1234)
+    first = maps(0, position)
+    np.random.seed(1234)
+    other = maps(2, position)
+    np.random.seed(5678)
+    again = maps(0, position)
+    for a, b, c in zip(first, other, again):
+        assert not np.array_equal(a, b)
+        np.testing.assert_array_equal(a, c)
+
+
+def test_position_maps_only_hit_position():
+    flip0, flip1 = maps(0, 3)
+    faulty = np.nonzero(flip0 | flip1)[1] % 8
+    assert faulty.size > 0
+    assert (faulty == 3).all()
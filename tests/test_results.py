@@ -0,0 +1,85 @@
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+import zs_results  # noqa: E402
+
+
+def params(checkpoint, seed=0):
+    return dict(
+        arch="resnet18",
+        dataset="cifar10",
+        ber=0.01,
+        position=-1,
+        seed=seed,
+        faulty_layers=["conv", "linear"],
+        checkpoint=checkpoint,
+    )
+
+
+def records(value):
+    return {"predictions": np.full(10, value), "logits": np.zeros((10, 3))}
+
+
+def test_long_checkpoint_paths(tmp_path):
+    # Checkpoint file names longer than any fixed width string column,
+    # that only differ at their end
+    name = "resnet18_cifar10_p_8_model_fl_conv-linear_ber_0.010_pos_-1" * 4
+    first = os.path.join(tmp_path, "save", name + "_epoch_1.pth")
+    second = os.path.join(tmp_path, "save", name + "_epoch_2.pth")
+    assert len(os.path.basename(first)) > 200
+
+    worker_paths = []
+    for worker, checkpoint in enumerate([first, second]):
+        path = zs_results.worker_path(str(tmp_path / "results.h5"), worker)
+        with zs_results.ResultsWriter(path) as writer:
+            writer.append(params(checkpoint), 0.5 + worker, records(worker))
+        worker_paths.append(path)
+    merged = str(tmp_path / "merged.h5")
+    zs_results.merge(worker_paths, merged)
+
+    index = zs_results.read_index(merged)
+    assert len(index) == 2
+    assert sorted(row["checkpoint"].decode() for row in index) == [
+        os.path.basename(first),
+        os.path.basename(second),
+    ]
+    for worker, checkpoint in enumerate([first, second]):
+        run = zs_results.lookup(
+            merged,
+            "resnet18",
+            "cifar10",
+            0.01,
+            -1,
+            0,
+            ["conv", "linear"],
+            checkpoint,
+        )
+        assert run["accuracy"] == 0.5 + worker
+        np.testing.assert_array_equal(
+            run["predictions"], records(worker)["predictions"]
+        )
+
+    # A run of the same checkpoint replaces its row
+    with zs_results.ResultsWriter(merged) as writer:
+        writer.append(params(second), 0.25, records(2))
+    index = zs_results.read_index(merged)
+    assert len(index) == 2
+    assert sorted(index["accuracy"]) == [0.25, 0.5]
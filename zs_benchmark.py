@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+File: zs_benchmark.py
+
+This script benchmarks the execution options of the (fault injected)
+models on synthetic inputs, so that numbers are free of I/O noise, and
+checks the startup (import) time of zs_main.py.
+"""
+
+# Built-in modules
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Third party modules
+import torch
+from torch import nn
+
+# Own modules
+from config import cfg
+from models import compile_model, init_models_faulty
+
+# Constants
+
+INPUT_SHAPES = {
+    "lenet": (1, 28, 28),
+    "resnet18": (3, 32, 32),
+    "resnet34": (3, 32, 32),
+    "vgg11": (3, 32, 32),
+    "vgg16": (3, 32, 32),
+}
+
+# Modules that zs_main.py --help must not import
+STARTUP_FORBIDDEN = ["torch", "torchvision", "matplotlib", "models"]
+
+# Functions
+
+
+def info(msg):
+    print("zs_benchmark: %s" % str(msg))
+
+
+def build_model(args):
+    shape = INPUT_SHAPES[args.arch]
+    model, _ = init_models_faulty(
+        args.arch,
+        shape[0],
+        cfg.precision,
+        False,
+        None,
+        cfg.faulty_layers,
+        args.bit_error_rate,
+        -1,
+    )
+    return model.to(cfg.device)
+
+
+def synthetic_batch(args):
+    generator = torch.Generator().manual_seed(cfg.seed)
+    inputs = torch.rand(
+        (args.batch_size,) + INPUT_SHAPES[args.arch], generator=generator
+    )
+    labels = torch.randint(0, 10, (args.batch_size,), generator=generator)
+    return inputs.to(cfg.device), labels.to(cfg.device)
+
+
+def make_step(model, mode, inputs, labels):
+    if mode == "eval":
+        model.eval()
+
+        def step():
+            with torch.no_grad():
+                model(inputs)
+
+    else:
+        model.train()
+        opt = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+
+        def step():
+            opt.zero_grad()
+            loss = nn.CrossEntropyLoss()(model(inputs), labels)
+            loss.backward()
+            opt.step()
+
+    return step
+
+
+def time_step(step, iterations, warmup):
+    """
+    Return the time of the first call (including any compilation) and
+    the median step time after warmup, in seconds.
+    """
+    start = time.perf_counter()
+    step()
+    first = time.perf_counter() - start
+    for _ in range(warmup):
+        step()
+
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - start)
+    return first, statistics.median(times)
+
+
+def report(args, rows):
+    info(
+        "%s, batch size %d, %d threads, %d iterations"
+        % (args.arch, args.batch_size, torch.get_num_threads(), args.iters)
+    )
+    print(
+        "%-8s %-16s %12s %12s %12s"
+        % ("mode", "variant", "first (s)", "step (ms)", "images/s")
+    )
+    for mode, variant, first, step in rows:
+        print(
+            "%-8s %-16s %12.3f %12.2f %12.1f"
+            % (mode, variant, first, step * 1e3, args.batch_size / step)
+        )
+
+
+def bench_compile(args):
+    """
+    Compare eager vs. torch.compile step time.
+    """
+    inputs, labels = synthetic_batch(args)
+    rows = []
+    for mode in args.modes:
+        model = build_model(args)
+        step = make_step(model, mode, inputs, labels)
+        rows.append((mode, "eager") + time_step(step, args.iters, args.warmup))
+
+        model = build_model(args)
+        compiled = compile_model(model, args.compile_cache_dir)
+        step = make_step(compiled, mode, inputs, labels)
+        rows.append(
+            (mode, "compiled") + time_step(step, args.iters, args.warmup)
+        )
+    report(args, rows)
+
+
+def bench_channels_last(args):
+    """
+    Compare NCHW vs. channels last step time (same weights and inputs).
+    """
+    inputs, labels = synthetic_batch(args)
+    rows = []
+    for mode in args.modes:
+        outputs = []
+        for variant, mformat in (
+            ("nchw", torch.contiguous_format),
+            ("channels_last", torch.channels_last),
+        ):
+            torch.manual_seed(cfg.seed)
+            model = build_model(args).to(memory_format=mformat)
+            batch = inputs.contiguous(memory_format=mformat)
+            if mode == "eval":
+                model.eval()
+                with torch.no_grad():
+                    outputs.append(model(batch))
+            step = make_step(model, mode, batch, labels)
+            rows.append(
+                (mode, variant) + time_step(step, args.iters, args.warmup)
+            )
+        if mode == "eval":
+            info(
+                "max abs output difference nchw vs. channels last: %.3e"
+                % (outputs[0] - outputs[1]).abs().max()
+            )
+    report(args, rows)
+
+
+def parse_importtime(output):
+    """
+    Parse the stderr of python -X importtime. Returns a dict mapping the
+    top level imported modules to their cumulative import time (us) and
+    the set of all the imported modules.
+    """
+    top_level = {}
+    modules = set()
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules.add(name.strip())
+        if not name[1:].startswith(" "):
+            top_level[name.strip()] = int(cumulative)
+    return top_level, modules
+
+
+def bench_importtime(args):
+    """
+    Check the import time of zs_main.py --help against a budget, and that
+    no heavy module is imported before the mode is selected.
+    """
+    script = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "zs_main.py"
+    )
+    command = [sys.executable, "-X", "importtime", script, "--help"]
+    times = []
+    for _ in range(args.iters):
+        start = time.perf_counter()
+        result = subprocess.run(
+            command, capture_output=True, text=True, check=True
+        )
+        times.append(time.perf_counter() - start)
+        top_level, modules = parse_importtime(result.stderr)
+
+    total = sum(top_level.values()) / 1e3
+    info(
+        "zs_main.py --help: imports %.1f ms, process %.1f ms (median of %d)"
+        % (total, statistics.median(times) * 1e3, args.iters)
+    )
+    for name, cumulative in sorted(
+        top_level.items(), key=lambda item: -item[1]
+    )[:10]:
+        print("%-40s %10.1f ms" % (name, cumulative / 1e3))
+
+    failed = False
+    forbidden = sorted(set(STARTUP_FORBIDDEN) & modules)
+    if forbidden:
+        info("ERROR: heavy modules imported at startup: %s" % forbidden)
+        failed = True
+    if total > args.budget_ms:
+        info(
+            "ERROR: import time %.1f ms over budget (%.1f ms)"
+            % (total, args.budget_ms)
+        )
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+def main():
+    """
+    Program main
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "benchmark",
+        help="Benchmark to run",
+        choices=["compile", "channels-last", "importtime"],
+    )
+    parser.add_argument(
+        "arch",
+        help="Input network architecture (not used by importtime)",
+        choices=sorted(INPUT_SHAPES),
+        nargs="?",
+        default="lenet",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["train", "eval"],
+        help="Steps to benchmark.",
+        default=["train", "eval"],
+    )
+    parser.add_argument(
+        "-ber",
+        "--bit_error_rate",
+        type=float,
+        help="Bit error rate of the injected faults.",
+        default=0.01,
+    )
+    parser.add_argument(
+        "-BS", "--batch-size", type=int, help="Batch size.", default=64
+    )
+    parser.add_argument(
+        "--iters", type=int, help="Timed iterations.", default=20
+    )
+    parser.add_argument(
+        "--warmup", type=int, help="Warmup iterations.", default=3
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of intra-op threads (default: pytorch default).",
+        default=None,
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        help="Import time budget of zs_main.py --help (importtime).",
+        default=200.0,
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        help="Persistent torch.compile cache directory.",
+        default=cfg.compile_cache_dir,
+    )
+    args = parser.parse_args()
+
+    if args.benchmark == "importtime":
+        bench_importtime(args)
+        sys.exit(0)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(cfg.seed)
+    cfg.device = torch.device("cpu")
+
+    if args.benchmark == "compile":
+        bench_compile(args)
+    elif args.benchmark == "channels-last":
+        bench_channels_last(args)
+    sys.exit(0)
+
+
+# Main
+
+if __name__ == "__main__":  # run main if executed from the command line
+    # and the main method exists
+
+    if callable(locals().get("main")):
+        main()
+        sys.exit(0)
@@ -0,0 +1,524 @@
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Fault injection campaigns.
+
+The parent process loads the checkpoint and the whole test set once into
+shared memory tensors, then a pool of forked worker processes evaluates
+the points of the ber x position x seed grid. Every worker builds the
+faulty model of a point (its own fault maps) on top of the shared
+weights and runs it over the shared test set on CPU, with its own number
+of intra-op threads.
+
+Statistical fault injection (SFI) campaigns draw fault maps for every
+(ber, position, layer set) point until the confidence interval of the
+accuracy (or SDC rate) is narrower than a given margin, spending the run
+budget on the points with the most variance.
+"""
+
+import csv
+import itertools
+import math
+import os
+import statistics
+import time
+from concurrent import futures
+from statistics import NormalDist
+
+import torch
+import torch.multiprocessing as mp
+
+import zs_hooks_stats as stats
+from config import cfg
+from models import find_checkpoint, init_models_faulty, load_checkpoint
+from zs_golden import SDCMetrics, golden_outputs
+from zs_metrics import binomial_interval
+
+# State shared with the workers (set by init_worker)
+_worker = {}
+
+
+def shared_test_set(testloader):
+    """
+    Return the (normalized) test set as CPU tensors in shared memory.
+    """
+    images = []
+    labels = []
+    for inputs, classes in testloader:
+        images.append(inputs.cpu())
+        labels.append(classes.cpu())
+    return torch.cat(images).share_memory_(), torch.cat(labels).share_memory_()
+
+
+def shared_state_dict(checkpoint_path):
+    path = find_checkpoint(checkpoint_path)
+    if path is None:
+        raise FileNotFoundError("Checkpoint %s not found" % checkpoint_path)
+    print("Loading checkpoint", path)
+    state_dict = load_checkpoint(path, device="cpu", model_only=True)[
+        "model_state_dict"
+    ]
+    return {
+        name: tensor.clone().share_memory_()
+        for name, tensor in state_dict.items()
+    }
+
+
+def init_worker(state):
+    _worker.update(state)
+    torch.set_num_threads(state["threads"])
+    cfg.device = torch.device("cpu")
+
+
+def evaluate(point, faulty_layers=None):
+    """
+    Evaluate a (ber, position, seed) point in a worker, injecting faults
+    in faulty_layers (default: the campaign ones).
+    Returns the point, the accuracy and the logits.
+    """
+    ber, position, seed = point
+    model, _ = init_models_faulty(
+        _worker["arch"],
+        _worker["in_channels"],
+        _worker["precision"],
+        False,
+        None,
+        faulty_layers or _worker["faulty_layers"],
+        ber,
+        position,
+        seed=seed,
+    )
+    model.load_state_dict(_worker["state_dict"])
+    model.eval()
+
+    images, labels = _worker["images"], _worker["labels"]
+    batch_size = _worker["batch_size"]
+    with torch.no_grad():
+        logits = torch.cat(
+            [
+                model(images[first : first + batch_size])
+                for first in range(0, len(images), batch_size)
+            ]
+        )
+    accuracy = (logits.argmax(1) == labels).double().mean().item()
+    return point, accuracy, logits
+
+
+def prepare(
+    testloader,
+    arch,
+    dataset,
+    in_channels,
+    precision,
+    checkpoint_path,
+    faulty_layers,
+    threads,
+    sdc,
+):
+    """
+    Load the state shared with the workers and the golden run (if sdc).
+    """
+    state = {
+        "arch": arch,
+        "in_channels": in_channels,
+        "precision": precision,
+        "faulty_layers": faulty_layers,
+        "batch_size": cfg.test_batch_size,
+        "threads": threads,
+        "state_dict": shared_state_dict(checkpoint_path),
+    }
+    state["images"], state["labels"] = shared_test_set(testloader)
+    golden = None
+    if sdc:
+        golden = golden_outputs(
+            testloader,
+            arch,
+            dataset,
+            in_channels,
+            precision,
+            checkpoint_path,
+            cfg.device,
+        )
+        golden = tuple(tensor.cpu() for tensor in golden)
+    return state, golden
+
+
+def worker_pool(procs, state):
+    # Fork (where available) so the workers inherit the shared tensors
+    # without pickling them
+    methods = mp.get_all_start_methods()
+    context = mp.get_context("fork" if "fork" in methods else "spawn")
+    return futures.ProcessPoolExecutor(
+        procs, mp_context=context, initializer=init_worker, initargs=(state,)
+    )
+
+
+def run_metrics(accuracy, logits, golden):
+    metrics = {"accuracy": accuracy}
+    if golden is not None:
+        sdc_metrics = SDCMetrics(*golden)
+        sdc_metrics.update(logits)
+        metrics.update(sdc_metrics.values())
+    return metrics
+
+
+def format_metrics(metrics):
+    return ", ".join("%s %.4f" % item for item in metrics.items())
+
+
+def campaign(
+    testloader,
+    arch,
+    dataset,
+    in_channels,
+    precision,
+    checkpoint_path,
+    faulty_layers,
+    bers,
+    positions,
+    seeds,
+    procs,
+    threads,
+    results_path,
+    sdc=False,
+):
+    """
+    Run a fault injection campaign over the bers x positions x seeds grid.
+    The seeds must be at least 2 apart: the fault map of a point uses seed
+    and seed + 1 (at any position, see RandomFaultModel), so that every
+    row is reproducible from its seed whichever worker runs it.
+
+    :param procs: An int. Number of worker processes.
+    :param threads: An int. Intra-op threads of every worker.
+    :param results_path: A .csv file with one row per point, or an HDF5
+                         results file (.h5, see zs_results) where a run is
+                         appended per point.
+    :param sdc: A boolean. Compare every point against the golden run of
+                the checkpoint (see zs_golden).
+    """
+    state, golden = prepare(
+        testloader,
+        arch,
+        dataset,
+        in_channels,
+        precision,
+        checkpoint_path,
+        faulty_layers,
+        threads,
+        sdc,
+    )
+
+    points = list(itertools.product(bers, positions, seeds))
+    print(
+        "Campaign of %d points on %d processes x %d threads"
+        % (len(points), procs, threads)
+    )
+
+    start = time.perf_counter()
+    results = {}
+    with worker_pool(procs, state) as pool:
+        runs = [pool.submit(evaluate, point) for point in points]
+        for run in futures.as_completed(runs):
+            point, accuracy, logits = run.result()
+            metrics = run_metrics(accuracy, logits, golden)
+            results[point] = (metrics, logits)
+            print(
+                "[%d/%d] ber %.3e pos %d seed %d: %s"
+                % (
+                    (len(results), len(points))
+                    + point
+                    + (format_metrics(metrics),)
+                )
+            )
+    print("Campaign done in %.1f s" % (time.perf_counter() - start))
+
+    write_results(
+        results_path,
+        points,
+        results,
+        state["labels"],
+        arch,
+        dataset,
+        checkpoint_path,
+        faulty_layers,
+    )
+    return results
+
+
+class SFIPoint:
+    """
+    Runs of a (ber, position, layer set) point of a statistical fault
+    injection campaign. Every run (fault map) yields a proportion (e.g.
+    accuracy) over the test samples.
+    """
+
+    def __init__(self, ber, position, layers, seed):
+        self.ber = ber
+        self.position = position
+        self.layers = layers
+        self.next_seed = seed
+        self.values = []
+        self.successes = 0
+        self.trials = 0
+        self.pending = 0
+
+    def add(self, value, num_samples):
+        self.values.append(value)
+        self.successes += round(value * num_samples)
+        self.trials += num_samples
+
+    def interval(self, confidence, method):
+        """
+        Return the mean and the half width of its confidence interval: the
+        widest of the binomial interval over all the evaluated samples and
+        the normal interval of the mean across runs (fault maps).
+        """
+        low, high = binomial_interval(
+            self.successes, self.trials, confidence, method
+        )
+        half = (high - low) / 2
+        if len(self.values) > 1:
+            z = NormalDist().inv_cdf(0.5 + confidence / 2)
+            half = max(
+                half,
+                z
+                * statistics.stdev(self.values)
+                / math.sqrt(len(self.values)),
+            )
+        mean = self.successes / self.trials if self.trials else 0.0
+        return mean, half
+
+
+def sfi_campaign(
+    testloader,
+    arch,
+    dataset,
+    in_channels,
+    precision,
+    checkpoint_path,
+    layer_sets,
+    bers,
+    positions,
+    procs,
+    threads,
+    results_path,
+    metric="accuracy",
+    margin=0.01,
+    confidence=0.95,
+    budget=1000,
+    min_runs=3,
+    method="wilson",
+):
+    """
+    Statistical fault injection campaign with adaptive sample size. Fault
+    maps (seeds) are drawn for every ber x position x layer set point
+    until the confidence interval of metric is narrower than +/- margin.
+    Every run goes to the unconverged point with the widest interval
+    (i.e. with the most variance), until budget runs are used.
+
+    :param layer_sets: A list of lists of faulty layer types.
+    :param metric: "accuracy" or "sdc_rate".
+    :param margin: A float. Target half width of the intervals.
+    :param confidence: A float. Confidence level of the intervals.
+    :param budget: An int. Maximum total number of runs.
+    :param min_runs: An int. Runs of every point before checking its
+                     interval.
+    :param method: The binomial interval (see binomial_interval).
+    :param results_path: A .csv file with one row per point.
+    """
+    state, golden = prepare(
+        testloader,
+        arch,
+        dataset,
+        in_channels,
+        precision,
+        checkpoint_path,
+        layer_sets[0],
+        threads,
+        metric != "accuracy",
+    )
+    points = [
+        SFIPoint(ber, position, layers, cfg.seed)
+        for ber, position, layers in itertools.product(
+            bers, positions, layer_sets
+        )
+    ]
+    print(
+        "SFI campaign of %d points, margin %.4f at %.0f%% confidence, "
+        "budget %d runs on %d processes x %d threads"
+        % (len(points), margin, confidence * 100, budget, procs, threads)
+    )
+
+    def converged(point):
+        return (
+            len(point.values) >= min_runs
+            and point.interval(confidence, method)[1] <= margin
+        )
+
+    def priority(point):
+        # Expected half width once the pending runs complete
+        runs = len(point.values)
+        half = point.interval(confidence, method)[1]
+        return half * math.sqrt(runs / (runs + point.pending))
+
+    start = time.perf_counter()
+    submitted = 0
+    with worker_pool(procs, state) as pool:
+        running = {}
+
+        def submit(point):
+            seed = point.next_seed
+            # A fault map uses seed and seed + 1, at any position (see
+            # RandomFaultModel), so that the runs are independent
+            point.next_seed += 2
+            point.pending += 1
+            run = pool.submit(
+                evaluate, (point.ber, point.position, seed), point.layers
+            )
+            running[run] = point
+
+        for _ in range(min_runs):
+            for point in points:
+                if submitted < budget:
+                    submit(point)
+                    submitted += 1
+
+        while running:
+            done, _ = futures.wait(
+                running, return_when=futures.FIRST_COMPLETED
+            )
+            for run in done:
+                point = running.pop(run)
+                point.pending -= 1
+                (_, _, seed), accuracy, logits = run.result()
+                metrics = run_metrics(accuracy, logits, golden)
+                point.add(metrics[metric], len(logits))
+                mean, half = point.interval(confidence, method)
+                print(
+                    "[%d] ber %.3e pos %d layers %s seed %d: %s "
+                    "(%s %.4f +/- %.4f after %d runs)"
+                    % (
+                        submitted - len(running),
+                        point.ber,
+                        point.position,
+                        "-".join(point.layers),
+                        seed,
+                        format_metrics(metrics),
+                        metric,
+                        mean,
+                        half,
+                        len(point.values),
+                    )
+                )
+
+            while len(running) < procs and submitted < budget:
+                candidates = [
+                    point
+                    for point in points
+                    if len(point.values) >= min_runs and not converged(point)
+                ]
+                if not candidates:
+                    break
+                submit(max(candidates, key=priority))
+                submitted += 1
+
+    print(
+        "SFI campaign done in %.1f s, %d runs"
+        % (time.perf_counter() - start, submitted)
+    )
+    write_sfi_results(results_path, points, metric, confidence, method)
+    return points
+
+
+def write_sfi_results(results_path, points, metric, confidence, method):
+    directory = os.path.dirname(results_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(results_path, "w", newline="") as results_file:
+        writer = csv.writer(results_file)
+        writer.writerow(
+            ["ber", "position", "layers", "runs", metric, "half_width"]
+        )
+        for point in points:
+            mean, half = point.interval(confidence, method)
+            writer.writerow(
+                [
+                    point.ber,
+                    point.position,
+                    "-".join(point.layers),
+                    len(point.values),
+                    mean,
+                    half,
+                ]
+            )
+            print(
+                "ber %.3e pos %d layers %s: %s %.4f +/- %.4f (%d runs)"
+                % (
+                    point.ber,
+                    point.position,
+                    "-".join(point.layers),
+                    metric,
+                    mean,
+                    half,
+                    len(point.values),
+                )
+            )
+    print("Results saved to", results_path)
+
+
+def write_results(
+    results_path,
+    points,
+    results,
+    labels,
+    arch,
+    dataset,
+    checkpoint_path,
+    faulty_layers,
+):
+    if results_path.endswith(".h5"):
+        import zs_results
+
+        with zs_results.ResultsWriter(results_path) as writer:
+            for ber, position, seed in points:
+                metrics, logits = results[(ber, position, seed)]
+                logger = stats.DataLogger(len(labels), "cpu")
+                logger.update(logits)
+                params = {
+                    "arch": arch,
+                    "dataset": dataset,
+                    "ber": ber,
+                    "position": position,
+                    "seed": seed,
+                    "faulty_layers": faulty_layers,
+                    "checkpoint": checkpoint_path,
+                }
+                params.update(metrics)
+                accuracy = params.pop("accuracy")
+                logger.write(writer, params, accuracy)
+    else:
+        directory = os.path.dirname(results_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(results_path, "w", newline="") as results_file:
+            names = list(results[points[0]][0])
+            writer = csv.writer(results_file)
+            writer.writerow(["ber", "position", "seed"] + names)
+            for point in points:
+                metrics = results[point][0]
+                writer.writerow(
+                    list(point) + [metrics[name] for name in names]
+                )
+    print("Results saved to", results_path)
@@ -0,0 +1,545 @@
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Data set loaders.
+
+Two backends are supported:
+- torchvision: torchvision data sets with PIL transforms and a DataLoader.
+- tensor: every split is decoded once into an uint8 tensor stored in a
+  memory-mapped file under cfg.data_dir. Normalization, random crop with
+  padding and flips are applied as vectorized batch operations on the
+  target device.
+
+In offline mode (cfg.offline) nothing is downloaded nor verified against
+the archives checksums: the presence of the data files is checked against
+a manifest written under cfg.data_dir by the last online run.
+
+The test split can be reduced to a deterministic class-stratified subset
+(cfg.eval_samples or cfg.eval_fraction) for fast accuracy estimates.
+
+The synthetic data set is made of deterministic random uint8 images with
+the shape of one of the real data sets (cfg.synthetic_shape), generated
+directly on the target device and served by a TensorLoader. It needs no
+files nor network and is meant for benchmarking the models.
+"""
+
+import json
+import math
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from config import cfg
+
+__all__ = ["DATASETS", "get_loaders", "loader_benchmark", "TensorLoader"]
+
+# name: name used in the model paths, channels/size: input image shape,
+# torchvision: data set class, folder: its directory under cfg.data_dir,
+# norm: per split (mean, std), crop_padding/flip: training augmentation
+DATASETS = {
+    "cifar10": {
+        "name": "cifar",
+        "channels": 3,
+        "size": 32,
+        "torchvision": "CIFAR10",
+        "folder": "cifar-10-batches-py",
+        "norm": {"train": ((0.5,), (0.5,)), "test": ((0.5,), (0.5,))},
+        "crop_padding": 4,
+        "flip": True,
+    },
+    "mnist": {
+        "name": "mnist",
+        "channels": 1,
+        "size": 28,
+        "torchvision": "MNIST",
+        "folder": "MNIST",
+        "norm": {
+            "train": ((0.1307,), (0.3081,)),
+            "test": ((0.1307,), (0.3081,)),
+        },
+        "crop_padding": 0,
+        "flip": False,
+    },
+    "fashion": {
+        "name": "fashion",
+        "channels": 1,
+        "size": 28,
+        "torchvision": "FashionMNIST",
+        "folder": "FashionMNIST",
+        # per channel means and std devs
+        "norm": {
+            "train": ((0.2860,), (0.3530,)),
+            "test": ((0.2868,), (0.3524,)),
+        },
+        "crop_padding": 0,
+        "flip": False,
+    },
+}
+
+
+def get_loaders(dataset, device, splits=("train", "test")):
+    """
+    Build the loaders of the requested splits of dataset with the
+    configured backend (cfg.data_backend). Splits not requested are not
+    loaded (None is returned instead).
+    Returns the dataset name used in model paths, the input channels and
+    the train and test loaders.
+    """
+    if dataset == "synthetic":
+        spec = dict(DATASETS[cfg.synthetic_shape])
+        spec["name"] = "synthetic_" + spec["name"]
+    else:
+        spec = DATASETS[dataset]
+    loaders = {"train": None, "test": None}
+    for split in splits:
+        if dataset == "synthetic":
+            loaders[split] = synthetic_loader(spec, split, device)
+        elif cfg.data_backend == "tensor":
+            loaders[split] = tensor_loader(spec, split, device)
+        else:
+            loaders[split] = torchvision_loader(spec, split)
+    return spec["name"], spec["channels"], loaders["train"], loaders["test"]
+
+
+def torchvision_dataset(spec, split, transform=None):
+    # torchvision is slow to import, only load it when it is used
+    import torchvision
+
+    dataset_class = getattr(torchvision.datasets, spec["torchvision"])
+    if cfg.offline:
+        check_manifest(spec)
+        dataset_class = type(
+            dataset_class.__name__,
+            (dataset_class,),
+            {
+                # Presence already verified against the manifest
+                "_check_exists": lambda self: True,
+                "_check_integrity": lambda self: True,
+            },
+        )
+
+    dataset = dataset_class(
+        root=cfg.data_dir,
+        train=split == "train",
+        download=not cfg.offline,
+        transform=transform,
+    )
+
+    if not cfg.offline:
+        update_manifest(spec)
+    return dataset
+
+
+def manifest_path():
+    return os.path.join(cfg.data_dir, "eerai_manifest.json")
+
+
+def read_manifest():
+    if not os.path.exists(manifest_path()):
+        return {}
+    with open(manifest_path()) as manifest_file:
+        return json.load(manifest_file)
+
+
+def dataset_files(spec):
+    """
+    List the (relative path, size) of the files of a data set.
+    """
+    folder = os.path.join(cfg.data_dir, spec["folder"])
+    files = []
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            files.append(
+                [os.path.relpath(path, cfg.data_dir), os.path.getsize(path)]
+            )
+    return sorted(files)
+
+
+def update_manifest(spec):
+    manifest = read_manifest()
+    files = dataset_files(spec)
+    if manifest.get(spec["folder"]) == files:
+        return
+    manifest[spec["folder"]] = files
+    tmp_path = manifest_path() + ".tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(tmp_path, manifest_path())
+
+
+def check_manifest(spec):
+    """
+    Check that all the files of the data set listed in the manifest are
+    present (with the same size). Raises FileNotFoundError otherwise.
+    """
+    files = read_manifest().get(spec["folder"])
+    if not files:
+        raise FileNotFoundError(
+            "Data set %s not found in the manifest %s (offline mode). Run "
+            "once without --offline to download it."
+            % (spec["torchvision"], manifest_path())
+        )
+    for relpath, size in files:
+        path = os.path.join(cfg.data_dir, relpath)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            raise FileNotFoundError(
+                "Data set %s is incomplete (offline mode): %s is missing or "
+                "has changed. Run once without --offline to download it."
+                % (spec["torchvision"], path)
+            )
+
+
+def torchvision_loader(spec, split):
+    import torchvision.transforms as transforms
+
+    ops = []
+    if split == "train" and spec["crop_padding"] > 0:
+        ops.append(
+            transforms.RandomCrop(spec["size"], padding=spec["crop_padding"])
+        )
+    if split == "train" and spec["flip"]:
+        ops.append(transforms.RandomHorizontalFlip())
+    ops.append(transforms.ToTensor())
+    ops.append(transforms.Normalize(*spec["norm"][split]))
+
+    dataset = torchvision_dataset(spec, split, transforms.Compose(ops))
+    if split == "test":
+        indices = eval_subset(dataset.targets)
+        if indices is not None:
+            dataset = torch.utils.data.Subset(dataset, indices.tolist())
+    train = split == "train"
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=cfg.batch_size if train else cfg.test_batch_size,
+        shuffle=train,
+        **loader_options()
+    )
+
+
+def eval_subset(labels):
+    """
+    Return the (sorted) indices of the evaluation subset of a test set
+    given its labels, or None to evaluate the whole test set.
+    The subset size is cfg.eval_samples or cfg.eval_fraction of the set.
+    """
+    num_samples = len(labels)
+    if cfg.eval_samples > 0:
+        size = min(cfg.eval_samples, num_samples)
+    elif 0 < cfg.eval_fraction < 1:
+        size = max(1, round(cfg.eval_fraction * num_samples))
+    else:
+        return None
+    indices = stratified_subset(torch.as_tensor(labels), size, cfg.seed)
+    print("Evaluating on a subset of %d / %d samples" % (size, num_samples))
+    return indices
+
+
+def apply_eval_subset(images, labels):
+    indices = eval_subset(labels)
+    if indices is None:
+        return images, labels
+    indices = indices.to(labels.device)
+    return images[indices], labels[indices]
+
+
+def stratified_subset(labels, size, seed):
+    """
+    Deterministically sample size indices keeping the class proportions
+    of labels (largest remainder allocation of the per class quotas).
+    Returns the sorted indices.
+    """
+    labels = labels.cpu()
+    classes, counts = torch.unique(labels, return_counts=True)
+    quotas = counts.double() * size / len(labels)
+    allocation = quotas.floor().long()
+    remainder = size - int(allocation.sum())
+    if remainder > 0:
+        order = torch.argsort(quotas - allocation, descending=True)
+        allocation[order[:remainder]] += 1
+    generator = torch.Generator().manual_seed(seed)
+    indices = []
+    for label, count in zip(classes, allocation.tolist()):
+        members = torch.nonzero(labels == label).flatten()
+        order = torch.randperm(len(members), generator=generator)
+        indices.append(members[order[:count]])
+    return torch.sort(torch.cat(indices)).values
+
+
+def loader_options():
+    """
+    DataLoader performance options. Options set to None in cfg are
+    derived from the number of CPUs and the device.
+    """
+    num_workers = cfg.num_workers
+    if num_workers is None:
+        num_workers = min(8, max((os.cpu_count() or 1) - 1, 0))
+
+    pin_memory = cfg.pin_memory
+    if pin_memory is None:
+        pin_memory = cfg.device is not None and cfg.device.type == "cuda"
+
+    options = {
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+        "worker_init_fn": seed_worker,
+    }
+    if num_workers > 0:
+        # Keep the workers alive across epochs and accuracy checks
+        options["persistent_workers"] = (
+            cfg.persistent_workers
+            if cfg.persistent_workers is not None
+            else True
+        )
+        options["prefetch_factor"] = (
+            cfg.prefetch_factor if cfg.prefetch_factor is not None else 2
+        )
+    return options
+
+
+def seed_worker(worker_id):
+    """
+    Seed numpy and random in every worker from its torch seed, so that
+    workers do not share random augmentations.
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def loader_benchmark(loader, device, max_batches=0):
+    """
+    Measure the loader-only throughput, including the copy to device.
+    """
+    if isinstance(loader, torch.utils.data.DataLoader):
+        print(
+            "Loader: %d workers, pin_memory %s, persistent_workers %s, "
+            "prefetch_factor %s"
+            % (
+                loader.num_workers,
+                loader.pin_memory,
+                loader.persistent_workers,
+                loader.prefetch_factor,
+            )
+        )
+    else:
+        print("Loader: tensors on %s" % loader.device)
+    images = 0
+    batches = 0
+    first = None
+    start = time.perf_counter()
+    for inputs, labels in loader:
+        inputs = inputs.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        images += inputs.size(0)
+        batches += 1
+        if first is None:
+            first = time.perf_counter() - start
+        if max_batches > 0 and batches >= max_batches:
+            break
+    if batches == 0:
+        print("Loaded 0 batches")
+        return
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    print(
+        "Loaded %d images (%d batches) in %.3f s (first batch %.3f s): "
+        "%.1f images/s" % (images, batches, elapsed, first, images / elapsed)
+    )
+
+
+def tensor_cache_paths(spec, split):
+    cache_dir = os.path.join(cfg.data_dir, "tensor_cache")
+    prefix = os.path.join(cache_dir, "%s_%s" % (spec["name"], split))
+    return prefix + "_images.npy", prefix + "_labels.npy"
+
+
+def tensor_cache(spec, split):
+    """
+    Return the (images, labels) tensors of a split, decoding it into the
+    tensor cache the first time. Images are uint8 NCHW tensors backed by
+    a memory-mapped file.
+    """
+    images_path, labels_path = tensor_cache_paths(spec, split)
+
+    if not os.path.exists(images_path) or not os.path.exists(labels_path):
+        print("Decoding %s %s split into tensor cache" % (spec["name"], split))
+        dataset = torchvision_dataset(spec, split)
+        images = np.asarray(dataset.data, dtype=np.uint8)
+        if images.ndim == 3:
+            images = images[:, None, :, :]
+        else:
+            # CIFAR images are stored NHWC
+            images = images.transpose(0, 3, 1, 2)
+        labels = np.asarray(dataset.targets, dtype=np.int64)
+
+        os.makedirs(os.path.dirname(images_path), exist_ok=True)
+        for path, data in ((images_path, images), (labels_path, labels)):
+            tmp_path = path + ".tmp.npy"
+            np.save(tmp_path, np.ascontiguousarray(data))
+            os.replace(tmp_path, path)
+
+    # Copy-on-write mapping: nothing is read until it is used
+    images = torch.from_numpy(np.load(images_path, mmap_mode="c"))
+    labels = torch.from_numpy(np.load(labels_path, mmap_mode="c"))
+    return images, labels
+
+
+def tensor_loader(spec, split, device):
+    images, labels = tensor_cache(spec, split)
+    if split == "test":
+        images, labels = apply_eval_subset(images, labels)
+    train = split == "train"
+    mean, std = spec["norm"][split]
+    return TensorLoader(
+        images,
+        labels,
+        cfg.batch_size if train else cfg.test_batch_size,
+        device,
+        mean,
+        std,
+        shuffle=train,
+        crop_padding=spec["crop_padding"] if train else 0,
+        flip=spec["flip"] and train,
+        seed=cfg.seed,
+    )
+
+
+def synthetic_loader(spec, split, device):
+    """
+    Generate cfg.synthetic_size random images and labels with the shape of
+    spec on device. Splits use different seeds derived from cfg.seed.
+    """
+    generator = torch.Generator(device=device)
+    generator.manual_seed(cfg.seed + (split == "test"))
+    images = torch.randint(
+        0,
+        256,
+        (cfg.synthetic_size, spec["channels"], spec["size"], spec["size"]),
+        generator=generator,
+        dtype=torch.uint8,
+        device=device,
+    )
+    labels = torch.randint(
+        0, 10, (cfg.synthetic_size,), generator=generator, device=device
+    )
+    if split == "test":
+        images, labels = apply_eval_subset(images, labels)
+    train = split == "train"
+    mean, std = spec["norm"][split]
+    return TensorLoader(
+        images,
+        labels,
+        cfg.batch_size if train else cfg.test_batch_size,
+        device,
+        mean,
+        std,
+        shuffle=train,
+        crop_padding=spec["crop_padding"] if train else 0,
+        flip=spec["flip"] and train,
+        seed=cfg.seed,
+    )
+
+
+class TensorLoader:
+    """
+    Iterate over batches of an uint8 image tensor, converting,
+    normalizing and augmenting whole batches on device.
+    It provides the DataLoader interface used by the training and test
+    loops (iteration, len(), dataset and batch_size).
+    """
+
+    def __init__(
+        self,
+        images,
+        labels,
+        batch_size,
+        device,
+        mean,
+        std,
+        shuffle=False,
+        crop_padding=0,
+        flip=False,
+        seed=0,
+    ):
+        self.images = images.to(device)
+        self.labels = labels.to(device)
+        self.dataset = torch.utils.data.TensorDataset(self.images, self.labels)
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.shuffle = shuffle
+        self.crop_padding = crop_padding
+        self.flip = flip
+        self.mean = torch.tensor(mean, device=device).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, device=device).view(1, -1, 1, 1)
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed)
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        num_samples = len(self.dataset)
+        if self.shuffle:
+            order = torch.randperm(
+                num_samples, generator=self.generator, device=self.device
+            )
+        for start in range(0, num_samples, self.batch_size):
+            if self.shuffle:
+                index = order[start : start + self.batch_size]
+                images, labels = self.images[index], self.labels[index]
+            else:
+                images = self.images[start : start + self.batch_size]
+                labels = self.labels[start : start + self.batch_size]
+            yield self.transform(images), labels
+
+    def transform(self, images):
+        if self.crop_padding > 0:
+            images = self.random_crop(images)
+        images = images.float().div_(255)
+        if self.flip:
+            flip = torch.rand(
+                images.size(0), generator=self.generator, device=self.device
+            )
+            images = torch.where(
+                flip.view(-1, 1, 1, 1) < 0.5, images.flip(3), images
+            )
+        return images.sub_(self.mean).div_(self.std)
+
+    def random_crop(self, images):
+        """
+        Zero pad the batch and crop every image at a random offset.
+        """
+        n, _, h, w = images.shape
+        padding = self.crop_padding
+        padded = F.pad(images, (padding, padding, padding, padding))
+        offsets = torch.randint(
+            0,
+            2 * padding + 1,
+            (2, n, 1),
+            generator=self.generator,
+            device=self.device,
+        )
+        rows = offsets[0] + torch.arange(h, device=self.device)
+        cols = offsets[1] + torch.arange(w, device=self.device)
+        batch = torch.arange(n, device=self.device).view(-1, 1, 1)
+        # Advanced indexing gives (n, h, w, c)
+        crops = padded[batch, :, rows[:, :, None], cols[:, None, :]]
+        return crops.permute(0, 3, 1, 2)
@@ -14,48 +14,129 @@
 
 from __future__ import division
 
+import functools
+import json
+import time
+
 import numpy as np
 import torch
 from torch import nn
+from torch.nn import functional as F
 
 import zs_hooks_stats as stats
+from config import cfg
 from models import init_models_faulty
 
 verbose = True
-layer_counter = 0
 # batch_size = 10
 # input_shape = (3, 32, 32)
-layer_density = {}
-energy_skip_comp = {}
-energy_skip_inst = {}
-energy_total = {}
+
+
+# Keys of the hardware energy model files (see energymodels)
+ENERGY_MODEL_KEYS = [
+    "name",
+    "instruction_energy",
+    "multiplies",
+    "vector_length",
+    "accumulators",
+    "block",
+    "density_energy_scale",
+    "memory_access_energy",
+]
+MEMORY_ACCESSES = ["activation_read", "weight_read", "output_write"]
+
+
+def check_energy_model(model, source):
+    missing = [key for key in ENERGY_MODEL_KEYS if key not in model]
+    # The memory access energies may be left uncharacterized (null)
+    missing += [
+        "memory_access_energy." + key
+        for key in MEMORY_ACCESSES
+        if key not in (model.get("memory_access_energy") or {key: None})
+    ]
+    if missing:
+        raise ValueError(
+            "Energy model %s misses %s" % (source, ", ".join(missing))
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def load_energy_model(path):
+    """
+    Load a hardware energy model file (JSON, or YAML if PyYAML is
+    installed), once per path.
+    """
+    with open(path) as model_file:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+
+            model = yaml.safe_load(model_file)
+        else:
+            model = json.load(model_file)
+    check_energy_model(model, path)
+    return model
 
 
 class EnergyEstimation:
-    def __init__(self):
+    def __init__(self, model=None):
+        """
+        :param model: A hardware energy model (dict) or model file
+                      (default: the first of cfg.energy_models).
+        """
+        if model is None:
+            model = cfg.energy_models[0]
+        if isinstance(model, str):
+            model = load_energy_model(model)
+        else:
+            check_energy_model(model, model.get("name", "<dict>"))
+        self.name = model["name"]
         # dynamic energy per instruction = 1 unit as of now since
         # I need to check if this value can be shared.
-        self.xvf32ger_energy = 395.2 * 0.505
-        self.xvf32ger_multiplies = 16
-        self.accumulators = 8  # 64B each
+        self.xvf32ger_energy = model["instruction_energy"]
+        self.xvf32ger_multiplies = model["multiplies"]
+        self.accumulators = model["accumulators"]  # 64B each
         # 4 instructions to create a 4x4 outer
         # product of two 4-element vectors
-        self.xvf32ger_n = 4
-        self.bblock_r = 8
-        self.bblock_c = 16
-        self.xvf32ger_energy_density_scale = [
-            0.203665988,
-            0.476610249,
-            0.601375176,
-            0.700340856,
-            0.801657264,
-            0.865362012,
-            0.910437236,
-            0.963622473,
-            0.990185708,
-            0.998883404,
-            1,
-        ]
+        self.xvf32ger_n = model["vector_length"]
+        self.bblock_r, self.bblock_c = model["block"]
+        self.xvf32ger_energy_density_scale = model["density_energy_scale"]
+        # None if not characterized
+        self.memory_access_energy = None
+        if model["memory_access_energy"] is not None:
+            self.memory_access_energy = [
+                model["memory_access_energy"][key] for key in MEMORY_ACCESSES
+            ]
+
+    def lookup_table(self, device=None):
+        """
+        Return the energy per instruction by number of zero-valued
+        activations of its vector (0 to n), a (3, n + 1) tensor whose rows
+        are: baseline, with skipped (all zero) instructions and with
+        skipped computations.
+        """
+        n = self.xvf32ger_n
+        zero_n = torch.arange(n + 1, dtype=torch.float64, device=device)
+        density = 1 - zero_n / n
+        # density 1, .75, .5, .25, 0 -> scale index 10, 7, 5, 2, 0
+        scale_max = len(self.xvf32ger_energy_density_scale) - 1
+        sparse_index = (density * scale_max).to(torch.uint8).long()
+        scale = torch.tensor(
+            self.xvf32ger_energy_density_scale,
+            dtype=torch.float64,
+            device=device,
+        )
+        energy = scale[sparse_index] * self.xvf32ger_energy
+        # instructions with density 0 are eliminated
+        energy_skip_inst = torch.where(
+            zero_n < n, energy, torch.zeros_like(energy)
+        )
+        # each zero-valued activation results in 4
+        # (multiplies / n) 0-valued partial products among 16
+        energy_reduction = (
+            self.xvf32ger_energy / self.xvf32ger_multiplies
+        ) * (zero_n * (self.xvf32ger_multiplies // n))
+        energy_skip_comp = self.xvf32ger_energy - energy_reduction
+        return torch.stack([energy, energy_skip_inst, energy_skip_comp])
 
     def baseline_energy_dataswitching(
         self, weight_size, input_size, output_size, density
@@ -66,9 +147,10 @@ class EnergyEstimation:
         The objective is to include the effect of data switching. This
         will be the baseline case.
         """
-        # number of instructions to compute 8x8 block with 8x4 and 4x16 inputs
+        # number of instructions to compute 8x16 block with 8xn and nx16 inputs
         bblock8x16_xvf32ger_n = self.accumulators * self.xvf32ger_n
-        sparse_index = np.array(np.round(density * 10), dtype=np.uint8)
+        scale_max = len(self.xvf32ger_energy_density_scale) - 1
+        sparse_index = np.array(np.round(density * scale_max), dtype=np.uint8)
         bblock8x16_energy = (
             bblock8x16_xvf32ger_n
             * self.xvf32ger_energy
@@ -82,8 +164,8 @@ class EnergyEstimation:
         M = output_size[0]
         K = input_size[0]  # or weight_size[1]
         N = output_size[1]
-        # block8x16_xvf32ger_n = bblock8x16_xvf32ger_n * K / 4
-        block8x16_energy = K / 4 * bblock8x16_energy
+        # block8x16_xvf32ger_n = bblock8x16_xvf32ger_n * K / n
+        block8x16_energy = K / self.xvf32ger_n * bblock8x16_energy
 
         block8x16_n = np.ceil(M / self.bblock_r) * np.ceil(N / self.bblock_c)
         energy = block8x16_n * block8x16_energy
@@ -100,14 +182,17 @@ class EnergyEstimation:
         sparsity exploitation, by way of perfect run-time prediction
         of 0-valued inputs and fine-grained clock-gating.
         We assume that since the prediction capability exists, 0-valued
-        computations can be eliminated from each of the 4x4 basic blocks,
+        computations can be eliminated from each of the nxn basic blocks,
         resulting in dynamic energy reduction .
         """
-        bblock8x16_xvf32ger_n = self.accumulators * self.xvf32ger_n
-        # number of instructions to compute 8x8 block with 8x4 and 4x16 inputs
-        computations_reduced = np.floor((1 - density) * 4) * 4
-        # Each 0-valued activation in 4-element vector results in
-        # elimination of 4 computations
+        n = self.xvf32ger_n
+        bblock8x16_xvf32ger_n = self.accumulators * n
+        # number of instructions to compute 8x16 block with 8xn and nx16 inputs
+        computations_reduced = np.floor((1 - density) * n) * (
+            self.xvf32ger_multiplies // n
+        )
+        # Each 0-valued activation in n-element vector results in
+        # elimination of multiplies / n computations
 
         energy_reduction = (
             self.xvf32ger_energy / self.xvf32ger_multiplies
@@ -118,121 +203,92 @@ class EnergyEstimation:
         M = output_size[0]
         K = input_size[0]  # or weight_size[1]
         N = output_size[1]
-        # block8x16_xvf32ger_n = bblock8x16_xvf32ger_n * K / 4
-        block8x16_energy = K / 4 * bblock8x16_energy
+        # block8x16_xvf32ger_n = bblock8x16_xvf32ger_n * K / n
+        block8x16_energy = K / n * bblock8x16_energy
 
         block8x16_n = np.ceil(M / self.bblock_r) * np.ceil(N / self.bblock_c)
         energy = block8x16_n * block8x16_energy
         print("uniform sparse with 0-valued computes eliminated", energy)
         return energy
 
-    def sparse_energy(
-        self, activations, weights, input_size, weight_size, output_size
-    ):
-        # Here activations is the 0-padded matrix
-        ishape = list(activations.shape)
-        wshape = list(weights.shape)
-
-        xvf32ger_instructions_eliminated = 0
-        xvf32ger_instructions = 0
-        xvf32ger_energy_total = 0.0
-        xvf32ger_energy_skip_inst = 0.0
-        xvf32ger_energy_skip_comp = 0.0
-        for b in range(0, ishape[0]):  # batches
-            for c in range(0, wshape[1]):  # input channels
-
-                # print(activations[b,c,:,:])
-                for i in range(0, wshape[2]):  # row stride
-                    for j in range(0, wshape[3]):  # column stride
-
-                        # assemble elements of one row of MMA activation matrix
-                        rowCount = 0
-                        for k in range(
-                            i, ishape[2] - wshape[2] + i + 1
-                        ):  # rows of activations
-                            # print(b,c,k,j, ishape[3]-wshape[3]+j+1)
-                            if rowCount == 0:
-                                mma_act_row = activations[
-                                    b, c, k, j : ishape[3] - wshape[3] + j + 1
-                                ]  # choose elements
-                            else:
-                                mma_act_row = torch.cat(
-                                    (
-                                        mma_act_row,
-                                        activations[
-                                            b,
-                                            c,
-                                            k,
-                                            j : ishape[3] - wshape[3] + j + 1,
-                                        ],
-                                    ),
-                                    0,
-                                )
-                            rowCount += 1
-                        # print(mma_act_row)
-                        # pdb.set_trace()
-
-                        # check for density in each 4-element sequence
-                        mshape = list(mma_act_row.shape)
-                        for m in range(0, np.ceil(mshape[0] / 4).astype(int)):
-                            xvf32ger_instructions += 1
-
-                            density = (
-                                1
-                                - (torch.sum(mma_act_row.view(-1)[:4:] == 0))
-                                / 4.0
-                            )
-                            if density == 0:
-                                xvf32ger_instructions_eliminated += 1
-                            else:
-                                sparse_index = (density * 10).to(torch.uint8)
-                                xvf32ger_energy_skip_inst += (
-                                    self.xvf32ger_energy_density_scale[
-                                        sparse_index
-                                    ]
-                                    * self.xvf32ger_energy
-                                )
-
-                            computes_skipped = torch.sum(
-                                mma_act_row.view(-1)[:4:] == 0
-                            )
-                            # each zero-valued activation results
-                            # in 4 0-valued partial products among 16
-                            energy_reduction = (
-                                (
-                                    self.xvf32ger_energy
-                                    / self.xvf32ger_multiplies
-                                )
-                                * computes_skipped
-                                * 4
-                            )
-                            sparse_energy = (
-                                self.xvf32ger_energy - energy_reduction
-                            )
-                            xvf32ger_energy_skip_comp += sparse_energy
-
-                            # baseline energy without skipping
-                            # sparse computations or instructions
-                            sparse_index = (density * 10).to(torch.uint8)
-                            xvf32ger_energy_total += (
-                                self.xvf32ger_energy_density_scale[
-                                    sparse_index
-                                ]
-                                * self.xvf32ger_energy
-                            )
-
-                            mma_act_row = mma_act_row.view(-1)[4::]
+    def zero_counts(self, rows):
+        """
+        Count the xvf32ger instructions over the rows of an MMA activation
+        matrix by number of zero-valued activations (0 to 4). Each row is
+        split in 4-element vectors, one instruction each; a last partial
+        vector is completed with nonzero values.
+
+        :param rows: The zero mask (1 for zeros, as floats) of the rows,
+                     of shape (..., row length).
+        :return: A tensor of 5 ints (on the rows device).
+        """
+        n = self.xvf32ger_n
+        rows = F.pad(rows, (0, -rows.shape[-1] % n))
+        zero_n = rows.reshape(-1, n).sum(1).long()
+        counts = torch.zeros(n + 1, dtype=torch.long, device=rows.device)
+        return counts.scatter_add_(0, zero_n, torch.ones_like(zero_n))
+
+    def conv_zero_counts(self, activations, layer, chunk_size=1 << 24):
+        """
+        zero_counts of a convolution: one MMA activation matrix row per
+        sample, input channel and kernel position (built with unfold,
+        with the stride, padding and dilation of the layer).
+
+        :param activations: The input activations (N, C, H, W).
+        :param layer: The nn.Conv2d layer.
+        :param chunk_size: An int. Approximate number of elements of the
+                           MMA activation matrix unfolded at once.
+        """
+        padding = layer._reversed_padding_repeated_twice
+        if layer.padding_mode == "zeros":
+            padded = F.pad(activations, padding)
+        else:
+            padded = F.pad(activations, padding, mode=layer.padding_mode)
+        # Unfold the zero mask rather than the activations
+        zeros = (padded == 0).to(torch.float32)
+        kernel_size = layer.kernel_size
+        sample_size = zeros[0].numel() * kernel_size[0] * kernel_size[1]
+        counts = 0
+        for batch in torch.split(zeros, max(1, chunk_size // sample_size)):
+            rows = F.unfold(
+                batch,
+                kernel_size,
+                dilation=layer.dilation,
+                stride=layer.stride,
+            )
+            counts = counts + self.zero_counts(rows)
+        return counts
+
+    def sparse_energy(self, counts, input_size, weight_size, output_size):
+        """
+        Instruction level energy of a layer from its zero_counts.
+        """
+        counts = counts.double()
+
+        n = self.xvf32ger_n
+        energy = self.lookup_table(counts.device) @ counts
+
+        xvf32ger_instructions = counts.sum()
+        # instructions with density 0 are eliminated
+        xvf32ger_instructions_eliminated = counts[n]
+        # baseline energy without skipping
+        # sparse computations or instructions
+        (
+            xvf32ger_energy_total,
+            xvf32ger_energy_skip_inst,
+            xvf32ger_energy_skip_comp,
+        ) = energy
 
         M = weight_size[0]
         K = input_size[0]
         N = input_size[1]
         xvf32ger_instructions_eliminated = xvf32ger_instructions_eliminated * (
-            M / 4
+            M / n
         )
-        xvf32ger_instructions = xvf32ger_instructions * (M / 4)
-        xvf32ger_energy_total = xvf32ger_energy_total * (M / 4)
-        xvf32ger_energy_skip_inst = xvf32ger_energy_skip_inst * (M / 4)
-        xvf32ger_energy_skip_comp = xvf32ger_energy_skip_comp * (M / 4)
+        xvf32ger_instructions = xvf32ger_instructions * (M / n)
+        xvf32ger_energy_total = xvf32ger_energy_total * (M / n)
+        xvf32ger_energy_skip_inst = xvf32ger_energy_skip_inst * (M / n)
+        xvf32ger_energy_skip_comp = xvf32ger_energy_skip_comp * (M / n)
 
         if verbose:
             print(M, K, N)
@@ -265,31 +321,74 @@ class EnergyEstimation:
             xvf32ger_energy_total,
             xvf32ger_energy_skip_inst,
             xvf32ger_energy_skip_comp,
+            xvf32ger_instructions,
+            xvf32ger_instructions_eliminated,
         )
 
 
-def mma_instructions_estimate(conv2d_i, conv2d_w, conv2d_o):
-
-    with torch.no_grad():
-        conv2d_input = conv2d_i.clone().detach()
-        conv2d_weight = conv2d_w.clone().detach()
-        conv2d_output = conv2d_o.clone().detach()
-
-        ee = EnergyEstimation()
-
-        i_shape = list(conv2d_input.shape)
-        o_shape = list(conv2d_output.shape)
-        w_shape = list(conv2d_weight.shape)
-        print("input", i_shape, "output", o_shape, "weight", w_shape)
-
-        # deriving matrix shapes for MMA instructions
-
-        mma_weight_shape = [w_shape[0], w_shape[1] * w_shape[2] * w_shape[3]]
+def mma_counts(ee, layer, layer_input, layer_output):
+    """
+    Return the zero_counts of a convolution (nn.Conv2d) or fully connected
+    (nn.Linear) layer, computed as MMA instructions, and the shapes of its
+    MMA weight, input and output matrices. The fully connected layers are
+    MxK * KxN matrix multiplies whose N are the samples.
+    """
+    i_shape = list(layer_input.shape)
+    o_shape = list(layer_output.shape)
+    w_shape = list(layer.weight.shape)
+
+    if isinstance(layer, nn.Conv2d):
+        # grouped convolutions: each group is a separate multiply
+        # whose rows only meet the weights of its output channels
+        mma_weight_shape = [
+            w_shape[0] // layer.groups,
+            w_shape[1] * w_shape[2] * w_shape[3],
+        ]
         mma_input_shape = [
             w_shape[1] * w_shape[2] * w_shape[3],
             o_shape[2] * o_shape[3],
         ]
-        mma_output_shape = [o_shape[1], o_shape[2] * o_shape[3]]
+        mma_output_shape = [
+            w_shape[0] // layer.groups,
+            o_shape[2] * o_shape[3],
+        ]
+        counts = ee.conv_zero_counts(layer_input, layer)
+    else:
+        features = layer_input.reshape(-1, i_shape[-1])
+        mma_weight_shape = w_shape
+        mma_input_shape = [w_shape[1], features.shape[0]]
+        mma_output_shape = [w_shape[0], features.shape[0]]
+        counts = ee.zero_counts((features.t() == 0).to(torch.float32))
+    return counts, mma_input_shape, mma_weight_shape, mma_output_shape
+
+
+def mma_instructions_estimate(layer, layer_input, layer_output, ee=None):
+    """
+    Estimate the energy of a convolution or fully connected layer (see
+    mma_counts) with an EnergyEstimation (default: the first of
+    cfg.energy_models).
+    """
+
+    with torch.no_grad():
+        if ee is None:
+            ee = EnergyEstimation()
+
+        print(
+            "input",
+            list(layer_input.shape),
+            "output",
+            list(layer_output.shape),
+            "weight",
+            list(layer.weight.shape),
+        )
+
+        # deriving matrix shapes for MMA instructions
+        (
+            counts,
+            mma_input_shape,
+            mma_weight_shape,
+            mma_output_shape,
+        ) = mma_counts(ee, layer, layer_input, layer_output)
 
         print(mma_weight_shape, mma_input_shape, mma_output_shape)
 
@@ -300,28 +399,20 @@ def mma_instructions_estimate(conv2d_i, conv2d_w, conv2d_o):
         # per-layer sparsity, where the computations that can be skipped
         # are randomly distributed, and the % density of activations
         # is the same for each block
-        # density = torch.count_nonzero(conv2d_input)/
-        # (i_shape[0]*i_shape[1]*i_shape[2]*i_shape[3])
-        density = 1 - (
-            torch.sum(conv2d_input == 0)
-            * 1.0
-            / (i_shape[0] * i_shape[1] * i_shape[2] * i_shape[3])
-        )
+        density = 1 - (torch.sum(layer_input == 0) * 1.0 / layer_input.numel())
         print("layer density %.4f" % (density))
         # ee.uniform_sparsity_energy(mma_weight_shape, mma_input_shape,
         # mma_output_shape, density.cpu().numpy())
 
-        # zeropadded activation matrix to compute instruction level sparsity
-        zpad = nn.ZeroPad2d(w_shape[2] - 2)
-        conv2d_input_z = zpad(conv2d_input)
-        # iz_shape = list(conv2d_input_z.shape)
+        # instruction level sparsity of the (zero padded) activations
         (
             xvf32ger_energy_total,
             xvf32ger_energy_skip_inst,
             xvf32ger_energy_skip_comp,
+            xvf32ger_instructions,
+            xvf32ger_instructions_eliminated,
         ) = ee.sparse_energy(
-            conv2d_input_z,
-            conv2d_weight,
+            counts,
             mma_input_shape,
             mma_weight_shape,
             mma_output_shape,
@@ -332,24 +423,276 @@ def mma_instructions_estimate(conv2d_i, conv2d_w, conv2d_o):
             xvf32ger_energy_total,
             xvf32ger_energy_skip_inst,
             xvf32ger_energy_skip_comp,
+            xvf32ger_instructions,
+            xvf32ger_instructions_eliminated,
         )
 
 
-def activations(self, input, output):
-    global layer_counter, energy_skip_inst, energy_skip_comp
-    if "Conv2d" in self.__class__.__name__:
-        (
-            density,
-            xvf32ger_energy_total,
-            xvf32ger_energy_skip_inst,
-            xvf32ger_energy_skip_comp,
-        ) = mma_instructions_estimate(input[0], self.weight, output)
-        layer_density[layer_counter] = density
-        energy_total[layer_counter] = xvf32ger_energy_total
-        energy_skip_inst[layer_counter] = xvf32ger_energy_skip_inst
-        energy_skip_comp[layer_counter] = xvf32ger_energy_skip_comp
+class EnergyTargets:
+    """
+    Hardware targets (energy models) compiled into lookup tensors, to
+    score the same instruction counts against all of them at once. The
+    targets must share the vector length of their instructions, which
+    determines the counts. The memory access energy is only scored if
+    all the targets characterize it.
+    """
+
+    ENERGIES = [
+        "energy_total",
+        "energy_skip_inst",
+        "energy_skip_comp",
+        "energy_memory",
+    ]
+
+    def __init__(self, models=None, device=None, memory=None):
+        """
+        :param models: A list of hardware energy models (dicts) or model
+                       files (default: cfg.energy_models).
+        :param device: The device of the lookup tensors.
+        :param memory: A boolean. Score the memory accesses (default: if
+                       all the models characterize their energy). Raises
+                       ValueError if a model does not.
+        """
+        if models is None:
+            models = cfg.energy_models
+        self.estimations = [EnergyEstimation(model) for model in models]
+        self.names = [ee.name for ee in self.estimations]
+        vector_lengths = {ee.xvf32ger_n for ee in self.estimations}
+        if len(vector_lengths) != 1:
+            raise ValueError(
+                "The energy models %s have different vector lengths"
+                % ", ".join(self.names)
+            )
+        self.vector_length = vector_lengths.pop()
+        # (targets, 3, vector_length + 1)
+        self.tables = torch.stack(
+            [ee.lookup_table(device) for ee in self.estimations]
+        )
+        uncharacterized = [
+            ee.name
+            for ee in self.estimations
+            if ee.memory_access_energy is None
+        ]
+        if memory and uncharacterized:
+            raise ValueError(
+                "The energy models %s do not characterize the memory "
+                "access energy" % ", ".join(uncharacterized)
+            )
+        self.energies = list(self.ENERGIES)
+        # (targets, 3)
+        self.memory = None
+        if memory is not False and not uncharacterized:
+            self.memory = torch.tensor(
+                [ee.memory_access_energy for ee in self.estimations],
+                dtype=torch.float64,
+                device=device,
+            )
+        else:
+            self.energies.remove("energy_memory")
+
+    def score(self, counts, accesses):
+        """
+        Return the energies (energies: ENERGIES, without energy_memory
+        if the memory is not scored) per target, a tensor of shape
+        (targets, ..., 4 or 3).
+
+        :param counts: A tensor (..., vector_length + 1) of instruction
+                       counts by number of zero-valued activations.
+        :param accesses: A tensor (..., 3) of memory accesses (see
+                         MEMORY_ACCESSES).
+        """
+        energies = torch.einsum("tez,...z->t...e", self.tables, counts)
+        if self.memory is None:
+            return energies
+        memory = torch.einsum("tm,...m->t...", self.memory, accesses)
+        return torch.cat([energies, memory.unsqueeze(-1)], -1)
+
+
+class EnergyAccumulator:
+    """
+    Per layer energy accounting across batches, keyed by module name. The
+    layers are registered upfront and their totals (nonzero and total
+    input activations, instruction counts by number of zero-valued
+    activations and memory accesses, see fields) are accumulated in a
+    device tensor, so that no Python container grows and no sync happens
+    per batch. With num_batches, the values of every batch are kept too
+    (per batch granularity). The counts do not depend on the hardware
+    target: results scores them against any EnergyTargets (with the same
+    vector length).
+    """
+
+    def __init__(self, names, device, num_batches=0, vector_length=4):
+        """
+        :param names: The names of the layers (e.g. from named_modules).
+        :param device: The device of the accumulators.
+        :param num_batches: An int. Number of batches whose values are
+                            kept apart (0: totals only).
+        :param vector_length: An int. The vector length of the counted
+                              instructions.
+        """
+        self.names = list(names)
+        self.vector_length = vector_length
+        self.fields = (
+            ["nonzeros", "elements"]
+            + [
+                "instructions_%d_zeros" % zeros
+                for zeros in range(vector_length + 1)
+            ]
+            + MEMORY_ACCESSES
+        )
+        self.totals = torch.zeros(
+            len(self.names),
+            len(self.fields),
+            dtype=torch.float64,
+            device=device,
+        )
+        self.counts = torch.zeros(
+            len(self.names), dtype=torch.long, device=device
+        )
+        self.batch_values = None
+        if num_batches > 0:
+            self.batch_values = torch.zeros(
+                num_batches,
+                len(self.names),
+                len(self.fields),
+                dtype=torch.float64,
+                device=device,
+            )
+        self.batch = -1
+        # Constant fields (known from the shapes) per layer and shape
+        self.constants = {}
 
-    layer_counter += 1
+    def values(self, index, elements, accesses):
+        """
+        Return a new values tensor of the layer index whose elements and
+        memory accesses fields are set, the others zero. They are copied
+        to the device once per layer and input shape, not every batch.
+
+        :param index: An int. The index of the layer in names.
+        :param elements: An int. The number of input activations.
+        :param accesses: A list of memory accesses (see MEMORY_ACCESSES).
+        """
+        key = (index, elements, *accesses)
+        if key not in self.constants:
+            constants = torch.zeros(len(self.fields), dtype=torch.float64)
+            constants[1] = elements
+            constants[-len(accesses) :] = torch.tensor(
+                accesses, dtype=torch.float64
+            )
+            self.constants[key] = constants.to(self.totals.device)
+        return self.constants[key].clone()
+
+    def step(self):
+        """
+        Advance to the next batch (call before every batch).
+        """
+        self.batch += 1
+
+    def add(self, index, values):
+        """
+        :param index: An int. The index of the layer in names.
+        :param values: A tensor with the values of fields of the layer for
+                       the current batch.
+        """
+        self.totals[index] += values
+        self.counts[index] += 1
+        if self.batch_values is not None:
+            self.batch_values[self.batch, index] = values
+
+    def scores(self, targets, values=None):
+        """
+        Return the energies of values (default: the totals), a tensor
+        (..., fields), per target: a tensor (targets, ..., 4 or 3) (see
+        EnergyTargets.score).
+        """
+        if values is None:
+            values = self.totals
+        if targets.vector_length != self.vector_length:
+            raise ValueError(
+                "Instructions counted with vector length %d, not %d"
+                % (self.vector_length, targets.vector_length)
+            )
+        n = self.vector_length
+        return targets.score(values[..., 2 : n + 3], values[..., n + 3 :])
+
+    def results(self, targets):
+        """
+        Return a dict per layer (of the layers with estimates) with the
+        totals of fields, the instructions, eliminated instructions, mean
+        density of the input activations, number of batches and the
+        energies per target (syncs with device).
+        """
+        n = self.vector_length
+        totals = self.totals.tolist()
+        counts = self.counts.tolist()
+        scores = self.scores(targets).tolist()
+        results = {}
+        for index, (name, values, count) in enumerate(
+            zip(self.names, totals, counts)
+        ):
+            if count == 0:
+                continue
+            layer = dict(zip(self.fields, values))
+            layer["instructions"] = sum(values[2 : n + 3])
+            # instructions with density 0 are eliminated
+            layer["instructions_eliminated"] = values[n + 2]
+            layer["density"] = layer["nonzeros"] / layer["elements"]
+            layer["batches"] = count
+            layer["energy"] = {
+                target: dict(zip(targets.energies, scores[t][index]))
+                for t, target in enumerate(targets.names)
+            }
+            results[name] = layer
+        return results
+
+    def report(self, targets):
+        results = self.results(targets)
+        columns = {
+            "energy_total": "total",
+            "energy_skip_inst": "skip inst",
+            "energy_skip_comp": "skip comp",
+            "energy_memory": "memory",
+        }
+        energies = [key for key in columns if key in targets.energies]
+        for target in targets.names:
+            print("Energy model", target)
+            print(
+                "%-24s %8s %14s %10s"
+                % ("layer", "density", "instructions", "eliminated")
+                + " %12s"
+                * len(energies)
+                % tuple(columns[key] for key in energies)
+            )
+            for name, layer in results.items():
+                energy = layer["energy"][target]
+                print(
+                    "%-24s %8.4f %14d %10.4f"
+                    % (
+                        name,
+                        layer["density"],
+                        layer["instructions"],
+                        layer["instructions_eliminated"]
+                        / layer["instructions"],
+                    )
+                    + " %12.4e"
+                    * len(energies)
+                    % tuple(energy[key] for key in energies)
+                )
+
+
+def activations(ee, energy, index, module, input, output):
+    counts, _, mma_weight_shape, _ = mma_counts(ee, module, input[0], output)
+    values = energy.values(
+        index,
+        input[0].numel(),
+        [input[0].numel(), module.weight.numel(), output.numel()],
+    )
+    values[0] = torch.count_nonzero(input[0])
+    # every instruction is an outer product with n rows of the weights
+    values[2 : 2 + len(counts)] = counts.double() * (
+        mma_weight_shape[0] / ee.xvf32ger_n
+    )
+    energy.add(index, values)
 
 
 def inference_energy(
@@ -363,21 +706,57 @@ def inference_energy(
     fl,
     ber,
     pos,
+    hooks=None,
+    per_batch=False,
+    targets=None,
 ):
+    """
+    Estimate the per layer energy of the convolutions and fully connected
+    layers of a model over a test set. Returns the EnergyAccumulator of
+    the estimates.
+
+    :param hooks: The zs_hooks_stats.HookManager sampling the batches whose
+                  energy is estimated (default: the configured sampling).
+    :param per_batch: A boolean. Also keep the estimates of every batch.
+    :param targets: The EnergyTargets reported (default: the models of
+                    cfg.energy_models). The returned accumulator can be
+                    scored against other targets afterwards.
+    """
 
     model, checkpoint_epoch = init_models_faulty(
-        arch, in_channels, precision, True, checkpoint_path, fl, ber, pos
+        arch,
+        in_channels,
+        precision,
+        True,
+        checkpoint_path,
+        fl,
+        ber,
+        pos,
+        model_only=True,
     )
 
-    logger = stats.DataLogger(
-        int(len(testloader.dataset) / testloader.batch_size),
-        testloader.batch_size,
+    logger = stats.DataLogger(len(testloader.dataset), device)
+
+    if hooks is None:
+        hooks = stats.HookManager()
+    if targets is None:
+        targets = EnergyTargets(device=device)
+    ee = targets.estimations[0]
+    layers = [
+        (name, module)
+        for name, module in model.named_modules()
+        if isinstance(module, (nn.Conv2d, nn.Linear))
+    ]
+    energy = EnergyAccumulator(
+        [name for name, _ in layers],
+        device,
+        len(testloader) if per_batch else 0,
+        targets.vector_length,
     )
-
-    hooks = {}
-    for name, module in model.named_modules():
-        module.module_name = name
-        hooks[name] = module.register_forward_hook(activations)
+    for index, (name, module) in enumerate(layers):
+        hooks.register(
+            module, functools.partial(activations, ee, energy, index)
+        )
 
     model = model.to(device)
     # model = torch.nn.DataParallel(model)
@@ -386,8 +765,11 @@ def inference_energy(
     model.eval()
     model = model.to(device)
 
+    start = time.perf_counter()
     with torch.no_grad():
         for t, (inputs, classes) in enumerate(testloader):
+            hooks.step()
+            energy.step()
             inputs = inputs.to(device)
             classes = classes.to(device)
             model_outputs = model(inputs)
@@ -397,11 +779,13 @@ def inference_energy(
 
             logger.update(model_outputs)
 
+    logger.finalize()
+    hooks.report(time.perf_counter() - start)
+    hooks.remove()
     # logger.visualize()
     # forward pass of image perturbed with the program
+    energy.report(targets)
     f = open("outputs.txt", "w")
-    f.write(str(layer_density))
-    f.write(str(energy_total))
-    f.write(str(energy_skip_inst))
-    f.write(str(energy_skip_comp))
+    f.write(str(energy.results(targets)))
     f.close()
+    return energy
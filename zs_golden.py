@@ -0,0 +1,151 @@
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Golden (fault free) runs and silent data corruption (SDC) metrics.
+
+The outputs of the clean model of a checkpoint over a test set are
+computed once and cached under cfg.save_dir/golden, keyed by the sha256
+of the checkpoint file and the data set, so faulty runs of the same
+checkpoint are compared against them without re-running the clean model.
+"""
+
+import hashlib
+import os
+
+import torch
+
+from config import cfg
+from models import find_checkpoint, init_models, memory_format
+
+__all__ = ["golden_outputs", "SDCMetrics"]
+
+
+def checkpoint_hash(checkpoint_path):
+    sha = hashlib.sha256()
+    with open(checkpoint_path, "rb") as checkpoint_file:
+        for block in iter(lambda: checkpoint_file.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def golden_path(checkpoint_path, dataset, num_samples):
+    if cfg.eval_samples > 0 or 0 < cfg.eval_fraction < 1:
+        # The stratified subsets depend on the seed
+        dataset = "%s_seed%d" % (dataset, cfg.seed)
+    return os.path.join(
+        cfg.save_dir,
+        "golden",
+        "%s_%d_%s.pt"
+        % (dataset, num_samples, checkpoint_hash(checkpoint_path)),
+    )
+
+
+def golden_outputs(
+    testloader, arch, dataset, in_channels, precision, checkpoint_path, device
+):
+    """
+    Return the logits and labels (on device) of the clean model of
+    checkpoint_path over testloader, from the cache if present.
+    """
+    path = find_checkpoint(checkpoint_path)
+    if path is None:
+        raise FileNotFoundError("Checkpoint %s not found" % checkpoint_path)
+    cache_path = golden_path(path, dataset, len(testloader.dataset))
+
+    if os.path.exists(cache_path):
+        print("Golden run from cache", cache_path)
+        golden = torch.load(cache_path, map_location=device)
+        return golden["logits"], golden["labels"]
+
+    print("Golden run of", path)
+    model, _ = init_models(
+        arch, in_channels, precision, True, path, model_only=True
+    )
+    mformat = memory_format()
+    model = model.to(device, memory_format=mformat)
+    model.eval()
+    logits = []
+    labels = []
+    with torch.no_grad():
+        for inputs, classes in testloader:
+            inputs = inputs.to(
+                device, memory_format=mformat, non_blocking=True
+            )
+            logits.append(model(inputs))
+            labels.append(classes.to(device, non_blocking=True))
+    logits = torch.cat(logits)
+    labels = torch.cat(labels)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    torch.save({"logits": logits.cpu(), "labels": labels.cpu()}, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return logits, labels
+
+
+class SDCMetrics:
+    """
+    Compare the outputs of a faulty run against the golden run, batch by
+    batch, accumulating on device:
+    - sdc_rate: fraction of samples whose top-1 prediction differs from
+      the golden one (top-1 flips).
+    - critical_sdc_rate: fraction of samples correctly classified by the
+      golden run and misclassified by the faulty one.
+    - mean/max_logit_delta: mean and max absolute logit difference.
+    """
+
+    def __init__(self, golden_logits, labels):
+        self.golden_logits = golden_logits
+        self.golden_correct = golden_logits.argmax(1) == labels
+        device = golden_logits.device
+        self.flips = torch.zeros((), dtype=torch.long, device=device)
+        self.critical = torch.zeros((), dtype=torch.long, device=device)
+        self.delta_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.delta_max = torch.zeros((), device=device)
+        self.count = 0
+
+    def update(self, model_outputs):
+        """
+        :param model_outputs: The logits of the next samples of the run.
+        """
+        first, last = self.count, self.count + model_outputs.size(0)
+        golden = self.golden_logits[first:last]
+        flips = model_outputs.argmax(1) != golden.argmax(1)
+        self.flips += flips.sum()
+        self.critical += (flips & self.golden_correct[first:last]).sum()
+        delta = (model_outputs - golden).abs()
+        self.delta_sum += delta.sum()
+        self.delta_max = torch.maximum(self.delta_max, delta.max())
+        self.count = last
+
+    def values(self):
+        """
+        Return the metrics as a dict of floats (syncs with device).
+        """
+        return {
+            "sdc_rate": self.flips.item() / self.count,
+            "critical_sdc_rate": self.critical.item() / self.count,
+            "mean_logit_delta": self.delta_sum.item()
+            / self.golden_logits[: self.count].numel(),
+            "max_logit_delta": self.delta_max.item(),
+        }
+
+    def log(self):
+        print(
+            ", ".join(
+                "%s: %.5f" % (name, value)
+                for name, value in self.values().items()
+            )
+        )
@@ -12,100 +12,106 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import math
+import random
 import re
+import time
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 from torch import nn
 
-# resnet_layer_1_nza = 0
-# resnet_layer_1_nzw = 0
-# resnet_layer_2_nza = 0
-# resnet_layer_2_nzw = 0
-# resnet_layer_3_nza = 0
-# resnet_layer_3_nzw = 0
-# resnet_layer_4_nza = 0
-# resnet_layer_4_nzw = 0
-# resnet_layer_5_nza = 0
-# resnet_layer_5_nzw = 0
-
-resnet_layer_1 = 0
-resnet_layer_2 = 0
-resnet_layer_3 = 0
-resnet_layer_4 = 0
-resnet_layer_5 = 0
-
-vgg_layer_1 = 0
-vgg_layer_2 = 0
-vgg_layer_3 = 0
-vgg_layer_4 = 0
-vgg_layer_5 = 0
-vgg_layer_6 = 0
-vgg_layer_7 = 0
-vgg_layer_8 = 0
-
-
-debug = False
+from config import cfg
 
 
 class DataLogger:
-    def __init__(self, num_batches, batch_size):
-        print(
-            "init logger with number of batches %d, batch size %d"
-            % (num_batches, batch_size)
+    """
+    Record the per sample confidence (top-1 softmax probability), top-2
+    confidence difference, prediction and top-1 logit of a run in device
+    tensors preallocated for the data set size. They are copied to the
+    host (as numpy arrays) once, by finalize.
+    """
+
+    def __init__(self, num_samples, device):
+        """
+        :param num_samples: An int. The number of samples of the run
+                            (len(dataset), the last batch may be partial).
+        :param device: The device of the model outputs.
+        """
+        print("init logger with number of samples %d" % num_samples)
+        self.num_samples = num_samples
+        self.confidences = torch.zeros(num_samples, device=device)
+        self.confidence_diffs = torch.zeros(num_samples, device=device)
+        self.predictions = torch.zeros(
+            num_samples, dtype=torch.long, device=device
         )
-        self.confidences = np.zeros((num_batches, batch_size))
-        self.confidence_diffs = np.zeros((num_batches, batch_size))
-        self.predictions = np.zeros((num_batches, batch_size))
-        self.logits = np.zeros((num_batches, batch_size))
-        self.loss = np.zeros((num_batches))
-        self.batch_id = 0
-        self.batch_size = batch_size
+        self.logits = torch.zeros(num_samples, device=device)
+        self.count = 0
 
     def update(self, model_outputs):
-        softmax = nn.Softmax(dim=1)
-        confidences = torch.max(softmax(model_outputs), 1)
-        logits, predictions = torch.max(model_outputs, 1)
-        self.confidences[self.batch_id, 0 : self.batch_size] = (
-            confidences.values.detach().cpu().numpy()
-        )
-        self.predictions[self.batch_id, 0 : self.batch_size] = (
-            predictions.detach().cpu().numpy()
+        outputs = model_outputs.detach()
+        first, last = self.count, self.count + outputs.size(0)
+        if last > self.num_samples:
+            raise IndexError(
+                "DataLogger: %d samples logged, sized for %d"
+                % (last, self.num_samples)
+            )
+
+        top2 = torch.softmax(outputs.float(), 1).topk(2, 1).values
+        self.confidences[first:last] = top2[:, 0]
+        self.confidence_diffs[first:last] = top2[:, 0] - top2[:, 1]
+        self.logits[first:last], self.predictions[first:last] = torch.max(
+            outputs, 1
         )
-        self.logits[self.batch_id, 0 : self.batch_size] = (
-            logits.detach().cpu().numpy()
-        )
-        self.batch_id += 1
+        self.count = last
+
+    def finalize(self):
+        """
+        Copy the logged samples to the host, as numpy arrays.
+        """
+        if not isinstance(self.confidences, torch.Tensor):
+            return
+        for name in (
+            "confidences",
+            "confidence_diffs",
+            "predictions",
+            "logits",
+        ):
+            setattr(
+                self, name, getattr(self, name)[: self.count].cpu().numpy()
+            )
 
     def visualize(self):
+        self.finalize()
         print(np.histogram(self.confidences, 20))
         print(np.histogram(self.logits, np.arange(0, 60, 3)))
 
         # plot(self.confidences)
 
-    # def writeLog(self,run,voltage,ber,err_type):
-    #    if err_type == 1 or err_type == 3:
-    #        h5file = arch + '_' + dataset + '_' + chip + '.h5'
-    #        if os.path.exists(self.h5file):
-    #            hf = h5py.File(h5file, 'a')
-    #        else:
-    #            hf = h5py.File(h5file, 'w')
-    #        f_str = str(voltage)
-    #        g = hf.create_group(f_str)
-    #    else:
-    #        h5file = arch + '_' + dataset + '_' + rand + '.h5'
-    #        if os.path.exists(self.h5file):
-    #            hf = h5py.File(h5file, 'a')
-    #        else:
-    #            hf = h5py.File(h5file, 'w')
-    #        f_str = 'ber_'+str(ber) + '_run_' + str(run)_
-    #        g = hf.create_group(f_str)
-
-    #    g.create_dataset('confidences', data=self.confidences)
-    #    g.create_dataset('confidence_diffs', data=self.confidence_diffs)
-    #    g.create_dataset('predictions', data=self.predictions)
-    #    g.create_dataset('logits', data=self.logits)
+    def write(self, writer, params, accuracy):
+        """
+        Append the run to a results file.
+
+        :param writer: A zs_results.ResultsWriter.
+        :param params: A dict with the run parameters (arch, dataset, ber,
+                       position, seed, ...).
+        :param accuracy: A float. The run accuracy.
+        """
+        self.finalize()
+        writer.append(
+            params,
+            accuracy,
+            {
+                name: getattr(self, name)
+                for name in (
+                    "confidences",
+                    "confidence_diffs",
+                    "predictions",
+                    "logits",
+                )
+            },
+        )
 
 
 # end class
@@ -122,6 +128,8 @@ def inspect_model(model):
 
 
 def plot(data):
+    import matplotlib.pyplot as plt
+
     # plt.subplot(len(faulty_layers),1,l+1)
     # lb = 'BER '+str(ber[v])
     # plt.hist(weights, bins=20, range=(-0.25,0.25), log=True, label=lb)
@@ -150,248 +158,465 @@ def plot(data):
     #    plot(weights, v)
 
 
-def resnet_layer_1_stats(self, input, output):
-    # input is a tuple of packed inputs
-    # output is a Tensor. output.data is the Tensor we are interested
-    # print('output size:', output.data.size())
-    # osize = output.data.size().cpu().numpy()
-    # non_zeros=torch.count_nonzero(output.data)
-    # non_zeros=len(list(torch.nonzero(output.data).cpu()))
-    global resnet_layer_1
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    resnet_layer_1 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def resnet_layer_2_stats(self, input, output):
-    global resnet_layer_2
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    resnet_layer_2 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def resnet_layer_3_stats(self, input, output):
-    global resnet_layer_3
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    resnet_layer_3 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def resnet_layer_4_stats(self, input, output):
-    global resnet_layer_4
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    resnet_layer_4 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def resnet_layer_5_stats(self, input, output):
-    global resnet_layer_5
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    resnet_layer_5 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def vgg_layer_1_stats(self, input, output):
-    global vgg_layer_1
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    vgg_layer_1 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def vgg_layer_2_stats(self, input, output):
-    global vgg_layer_2
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    vgg_layer_2 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def vgg_layer_3_stats(self, input, output):
-    global vgg_layer_3
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    vgg_layer_3 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def vgg_layer_4_stats(self, input, output):
-    global vgg_layer_4
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    vgg_layer_4 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def vgg_layer_5_stats(self, input, output):
-    global vgg_layer_5
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    vgg_layer_5 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def vgg_layer_6_stats(self, input, output):
-    global vgg_layer_6
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    vgg_layer_6 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def vgg_layer_7_stats(self, input, output):
-    global vgg_layer_7
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    vgg_layer_7 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def vgg_layer_8_stats(self, input, output):
-    global vgg_layer_8
-    osize = torch.numel(output.data)
-    non_zeros = (
-        torch.numel(torch.nonzero(output.data)) / 4
-    )  # torch.nonzero returns the non-zero element indices
-    vgg_layer_8 += non_zeros / osize
-    if debug:
-        print("output non zero elements proportion %.3f" % (non_zeros / osize))
-
-
-def resnet_register_hooks(model, arch):
-    model.layer1[0].relu1.register_forward_hook(resnet_layer_1_stats)
-    model.layer1[0].relu2.register_forward_hook(resnet_layer_1_stats)
-    model.layer1[1].relu1.register_forward_hook(resnet_layer_1_stats)
-    model.layer1[1].relu2.register_forward_hook(resnet_layer_1_stats)
-    model.layer1[2].relu1.register_forward_hook(resnet_layer_1_stats)
-    model.layer1[2].relu2.register_forward_hook(resnet_layer_1_stats)
-
-    model.layer2[0].relu1.register_forward_hook(resnet_layer_2_stats)
-    model.layer2[0].relu2.register_forward_hook(resnet_layer_2_stats)
-    model.layer2[1].relu1.register_forward_hook(resnet_layer_2_stats)
-    model.layer2[1].relu2.register_forward_hook(resnet_layer_2_stats)
-    model.layer2[2].relu1.register_forward_hook(resnet_layer_2_stats)
-    model.layer2[2].relu2.register_forward_hook(resnet_layer_2_stats)
-    model.layer2[3].relu1.register_forward_hook(resnet_layer_2_stats)
-    model.layer2[3].relu2.register_forward_hook(resnet_layer_2_stats)
-
-    model.layer3[0].relu1.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[0].relu2.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[1].relu1.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[1].relu2.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[2].relu1.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[2].relu2.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[3].relu1.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[3].relu2.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[4].relu1.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[4].relu2.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[5].relu1.register_forward_hook(resnet_layer_3_stats)
-    model.layer3[5].relu2.register_forward_hook(resnet_layer_3_stats)
-
-    model.layer4[0].relu1.register_forward_hook(resnet_layer_4_stats)
-    model.layer4[0].relu2.register_forward_hook(resnet_layer_4_stats)
-    model.layer4[1].relu1.register_forward_hook(resnet_layer_4_stats)
-    model.layer4[1].relu2.register_forward_hook(resnet_layer_4_stats)
-    model.layer4[2].relu1.register_forward_hook(resnet_layer_4_stats)
-    model.layer4[2].relu2.register_forward_hook(resnet_layer_4_stats)
-    # elif arch == 'resnet34':
-    #    model.layer1[0].relu1.register_forward_hook(resnet_layer_1_stats)
-    #    model.layer2[0].relu1.register_forward_hook(resnet_layer_2_stats)
-    #    model.layer3[0].relu1.register_forward_hook(resnet_layer_3_stats)
-    #    model.layer4[0].relu1.register_forward_hook(resnet_layer_4_stats)
-
-
-#        model.layer5[0].relu1.register_forward_hook(resnet_layer_5_stats)
-
-
-def resnet_print_stats():
-    print(
-        "Proportion of non-zero elements in layer 1 %.3f"
-        % (resnet_layer_1 / 600)
-    )
-    print(
-        "Proportion of non-zero elements in layer 2 %.3f"
-        % (resnet_layer_2 / 800)
-    )
-    print(
-        "Proportion of non-zero elements in layer 3 %.3f"
-        % (resnet_layer_3 / 1200)
-    )
-    print(
-        "Proportion of non-zero elements in layer 4 %.3f"
-        % (resnet_layer_4 / 600)
-    )
-
-
-# print('Proportion of non-zero elements "
-# "in layer 5 %.3f'%(resnet_layer_5/100))
-
-
-def vgg_register_hooks(model, arch):
-    model.features[2].register_forward_hook(vgg_layer_1_stats)
-    model.features[5].register_forward_hook(vgg_layer_2_stats)
-    model.features[9].register_forward_hook(vgg_layer_3_stats)
-    model.features[12].register_forward_hook(vgg_layer_4_stats)
-    model.features[16].register_forward_hook(vgg_layer_5_stats)
-    model.features[19].register_forward_hook(vgg_layer_6_stats)
-    model.features[22].register_forward_hook(vgg_layer_7_stats)
-    model.features[26].register_forward_hook(vgg_layer_8_stats)
-
-
-#    model.features[29].register_forward_hook(vgg_layer_1_stats)
-#    model.features[32].register_forward_hook(vgg_layer_2_stats)
-#    model.features[36].register_forward_hook(vgg_layer_3_stats)
-#    model.features[39].register_forward_hook(vgg_layer_4_stats)
-#    model.features[42].register_forward_hook(vgg_layer_5_stats)
-
-
-def vgg_print_stats():
-    print("Proportion of non-zero elements %.3f" % (vgg_layer_1 / 100))
-    print("Proportion of non-zero elements %.3f" % (vgg_layer_2 / 100))
-    print("Proportion of non-zero elements %.3f" % (vgg_layer_3 / 100))
-    print("Proportion of non-zero elements %.3f" % (vgg_layer_4 / 100))
-    print("Proportion of non-zero elements %.3f" % (vgg_layer_5 / 100))
-    print("Proportion of non-zero elements %.3f" % (vgg_layer_6 / 100))
-    print("Proportion of non-zero elements %.3f" % (vgg_layer_7 / 100))
-    print("Proportion of non-zero elements %.3f" % (vgg_layer_8 / 100))
+class HookManager:
+    """
+    Forward hooks that only run on sampled batches, so that instrumentation
+    can be left in place at a negligible cost. A batch is sampled when it
+    satisfies all the policies: every Nth batch, within the first K
+    batches and in a random fraction of the batches. No hook runs when
+    cfg.hooks_enabled is off (global switch).
+    step() must be called before every batch. The time spent in the hooks
+    is measured to report their overhead. Used as a context manager, the
+    hooks are removed at exit.
+    """
+
+    def __init__(
+        self, every=None, first=None, fraction=None, seed=0, sync=False
+    ):
+        """
+        :param every: An int. Sample every Nth batch (default:
+                      cfg.hook_every).
+        :param first: An int. Only sample the first K batches, 0 for no
+                      limit (default: cfg.hook_first).
+        :param fraction: A float. Sample this random fraction of the
+                         batches (default: cfg.hook_fraction).
+        :param seed: An int. Seed of the random sampling.
+        :param sync: A boolean. Synchronize the device around the hooks
+                     so that their measured time includes device time.
+        """
+        self.every = cfg.hook_every if every is None else every
+        self.first = cfg.hook_first if first is None else first
+        self.fraction = cfg.hook_fraction if fraction is None else fraction
+        self.random = random.Random(seed)
+        self.sync = sync and torch.cuda.is_available()
+        self.handles = []
+        self.batch = -1
+        self.sampled = 0
+        self.active = False
+        self.hook_time = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.remove()
+
+    def step(self):
+        """
+        Advance to the next batch and decide whether it is sampled.
+        """
+        self.batch += 1
+        self.active = (
+            cfg.hooks_enabled
+            and len(self.handles) > 0
+            and self.batch % self.every == 0
+            and (self.first <= 0 or self.batch < self.first)
+            and (self.fraction >= 1 or self.random.random() < self.fraction)
+        )
+        self.sampled += self.active
+        return self.active
+
+    def register(self, module, hook):
+        """
+        Register hook(module, input, output) as a sampled forward hook.
+        """
+
+        def sampled_hook(module, input, output):
+            if not self.active:
+                return
+            if self.sync:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            hook(module, input, output)
+            if self.sync:
+                torch.cuda.synchronize()
+            self.hook_time += time.perf_counter() - start
+
+        handle = module.register_forward_hook(sampled_hook)
+        self.handles.append(handle)
+        return handle
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.active = False
+
+    def report(self, total_time=None):
+        """
+        Print the sampled batches and the time spent in the hooks
+        (relative to total_time, in seconds, if given).
+        """
+        overhead = ""
+        if total_time:
+            overhead = " (%.1f%% of %.2f s)" % (
+                100 * self.hook_time / total_time,
+                total_time,
+            )
+        print(
+            "Hooks: %d / %d batches sampled, %.3f s in hooks%s"
+            % (self.sampled, self.batch + 1, self.hook_time, overhead)
+        )
+
+
+class SparsityProfiler:
+    """
+    Activation sparsity profiler. Counts the nonzero outputs of every
+    module of a model of the given types (ReLUs and convolutions by
+    default) whose name matches a regular expression, keeping per module
+    running sums on device, and reports the per layer density at the end.
+    Only the batches sampled by its HookManager are profiled.
+    """
+
+    def __init__(
+        self,
+        model,
+        pattern="",
+        module_types=(nn.ReLU, nn.Conv2d),
+        manager=None,
+    ):
+        """
+        :param model: The model to profile.
+        :param pattern: A regular expression searched in the module names
+                        (named_modules) to select the profiled modules.
+        :param module_types: A tuple of the profiled module classes.
+        :param manager: The HookManager of the hooks (default: a new one
+                        with the configured sampling).
+        """
+        self.manager = manager if manager is not None else HookManager()
+        self.names = []
+        for name, module in model.named_modules():
+            if isinstance(module, module_types) and re.search(pattern, name):
+                self.manager.register(
+                    module, functools.partial(self.hook, len(self.names))
+                )
+                self.names.append(name)
+        # Allocated on the device of the first profiled output
+        self.nonzeros = None
+        self.numels = [0] * len(self.names)
+
+    def hook(self, index, module, input, output):
+        if self.nonzeros is None:
+            self.nonzeros = torch.zeros(
+                len(self.names), dtype=torch.long, device=output.device
+            )
+        self.nonzeros[index] += torch.count_nonzero(output.detach())
+        self.numels[index] += output.numel()
+
+    def remove(self):
+        self.manager.remove()
+
+    def densities(self):
+        """
+        Return a dict with the proportion of nonzero outputs per module
+        (syncs with device).
+        """
+        if self.nonzeros is None:
+            return {}
+        nonzeros = self.nonzeros.tolist()
+        return {
+            name: count / numel
+            for name, count, numel in zip(self.names, nonzeros, self.numels)
+            if numel > 0
+        }
+
+    def report(self):
+        for name, density in self.densities().items():
+            print(
+                "Proportion of non-zero elements in %s %.3f" % (name, density)
+            )
+
+
+class HistogramCollector:
+    """
+    Streaming histograms of the outputs (activations) and weights of the
+    modules of a model of the given types whose name matches a regular
+    expression, kept on device in constant memory across a whole test
+    set (only the batches sampled by its HookManager).
+
+    Linear histograms have bins uniform over [-R, R], where the range R
+    is the smallest power of two (at least 2^min_exp) that holds the
+    values. Every update is binned in the histogram of the smallest such
+    range that holds its values (one row per exponent), chosen on device,
+    and the rows are merged (2^k bins into one, exactly) into the range of
+    the largest one when read, so no value is clipped, no data is stored
+    and the updates never sync with the device. Magnitudes of 2^max_exp
+    or more are counted as overflow. Log histograms have bins uniform over
+    log2 |x| in [min_exp, max_exp] (magnitudes out of the range fall in
+    the first and last bins). The exact zeros, non-finite values, totals
+    and min/max (non-finite values taken as zeros) are counted apart, so
+    the densities (proportion of nonzero values) can drive sparsity-aware
+    estimates. Weights are
+    recorded once, from the stored (unperturbed) weights.
+    """
+
+    def __init__(
+        self,
+        model,
+        pattern="",
+        module_types=(nn.ReLU, nn.Conv2d, nn.Linear),
+        bins=None,
+        log=None,
+        min_exp=-24,
+        max_exp=8,
+        weights=True,
+        manager=None,
+    ):
+        """
+        :param model: The model to profile.
+        :param pattern: A regular expression searched in the module names
+                        (named_modules) to select the profiled modules.
+        :param module_types: A tuple of the profiled module classes.
+        :param bins: An int. Number of bins (even) per histogram
+                     (default: cfg.histogram_bins).
+        :param log: A boolean. Log2 magnitude bins instead of linear ones
+                    (default: cfg.histogram_log).
+        :param min_exp: An int. Lowest log2 magnitude of the log bins,
+                        and smallest log2 range of the linear bins.
+        :param max_exp: An int. Highest log2 magnitude of the log bins,
+                        and largest log2 range of the linear bins.
+        :param weights: A boolean. Also record the weights of the
+                        profiled modules (as <name>.weight).
+        :param manager: The HookManager of the hooks (default: a new one
+                        with the configured sampling).
+        """
+        self.manager = manager if manager is not None else HookManager()
+        self.bins = cfg.histogram_bins if bins is None else bins
+        self.log = cfg.histogram_log if log is None else log
+        assert self.bins % 2 == 0
+        self.min_exp = min_exp
+        self.max_exp = max_exp
+        self.names = []
+        self.weight_index = {}
+        for name, module in model.named_modules():
+            if isinstance(module, module_types) and re.search(pattern, name):
+                index = len(self.names)
+                self.names.append(name)
+                if weights and isinstance(
+                    getattr(module, "weight", None), torch.Tensor
+                ):
+                    self.weight_index[index] = len(self.names)
+                    self.names.append(name + ".weight")
+                self.manager.register(
+                    module, functools.partial(self.hook, index)
+                )
+        # Allocated on the device of the first profiled output
+        self.counts = None
+
+    def allocate(self, device):
+        size = len(self.names)
+        # Linear histograms have a row per log2 range (min_exp to max_exp)
+        # with an overflow bin on each side
+        if self.log:
+            shape = (size, 1, self.bins)
+        else:
+            shape = (size, self.max_exp - self.min_exp + 1, self.bins + 2)
+        self.counts = torch.zeros(shape, dtype=torch.long, device=device)
+        self.zeros = torch.zeros(size, dtype=torch.long, device=device)
+        self.nonfinite = torch.zeros(size, dtype=torch.long, device=device)
+        self.totals = torch.zeros(size, dtype=torch.long, device=device)
+        self.min = torch.full((size,), math.inf, device=device)
+        self.max = torch.full((size,), -math.inf, device=device)
+        self.ones = torch.ones(1, dtype=torch.long, device=device)
+        self.half = torch.tensor(float(self.bins // 2), device=device)
+
+    def hook(self, index, module, input, output):
+        if self.counts is None:
+            self.allocate(output.device)
+        self.update(index, output.detach())
+        if index in self.weight_index:
+            weight_index = self.weight_index.pop(index)
+            self.update(weight_index, module.weight.detach())
+
+    def update(self, index, values):
+        """
+        Add values (a tensor) to the histogram index, without syncing with
+        the device.
+        """
+        values = values.flatten().float()
+        self.totals[index] += values.numel()
+        # Non-finite values (NaN once multiplied by 0) are set to zero, then
+        # taken out of the zeros
+        nonfinite = torch.count_nonzero(values * 0)
+        self.nonfinite[index] += nonfinite
+        values = torch.nan_to_num(values, 0.0, 0.0, 0.0)
+        low, high = torch.aminmax(values)
+        self.min[index] = torch.minimum(self.min[index], low)
+        self.max[index] = torch.maximum(self.max[index], high)
+        empty = torch.count_nonzero(values == 0)
+        self.zeros[index] += empty - nonfinite
+
+        half = self.bins // 2
+        if self.log:
+            bins = values.abs().clamp_(min=2.0**self.min_exp).log2_()
+            bins = (
+                bins.sub_(self.min_exp)
+                .mul_(self.bins / (self.max_exp - self.min_exp))
+                .clamp_(0, self.bins - 1)
+                .long()
+            )
+            zero_bin = self.ones.new_zeros(1)
+        else:
+            # Row of the smallest range 2^exponent holding all the values
+            _, exponent = torch.frexp(torch.maximum(-low, high))
+            exponent = exponent.clamp(self.min_exp, self.max_exp)
+            zero_bin = (exponent - self.min_exp) * (self.bins + 2) + half + 1
+            bins = (
+                values.mul(torch.ldexp(self.half, -exponent))
+                .floor_()
+                .clamp_(-half - 1, half)
+                .add_(zero_bin)
+                .long()
+            )
+        counts = self.counts[index].view(-1)
+        counts.scatter_add_(0, bins, self.ones.expand_as(bins))
+        counts.scatter_add_(0, zero_bin.long().view(1), -empty.view(1))
+
+    def histograms(self):
+        """
+        Return the counts (numpy array of histograms x bins), the half
+        ranges R of the linear bins (None for log histograms) and the
+        overflow counts of the histograms (syncs with device).
+        """
+        counts = self.counts.cpu().numpy()
+        if self.log:
+            return counts[:, 0], None, np.zeros(len(counts), dtype=np.int64)
+        overflow = counts[:, :, 0].sum(1) + counts[:, :, -1].sum(1)
+        counts = counts[:, :, 1:-1]
+        histograms = np.zeros((len(counts), self.bins), dtype=np.int64)
+        ranges = np.full(len(counts), 2.0**self.min_exp)
+        offsets = np.arange(self.bins) - self.bins // 2
+        for index, rows in enumerate(counts):
+            used = np.flatnonzero(rows.any(1))
+            if len(used) == 0:
+                continue
+            top = used[-1]
+            ranges[index] = 2.0 ** (self.min_exp + top)
+            for row in used:
+                # Merge 2^k bins of a smaller range into one
+                merged = offsets // 2 ** (top - row) + self.bins // 2
+                np.add.at(histograms[index], merged, rows[row])
+        return histograms, ranges, overflow
+
+    def remove(self):
+        self.manager.remove()
+
+    def edges(self, limit=None):
+        """
+        Return the bin edges (numpy array of bins + 1 floats) of a linear
+        histogram of half range limit (see histograms), or of the log
+        histograms (log2 magnitudes).
+        """
+        if self.log:
+            return np.linspace(self.min_exp, self.max_exp, self.bins + 1)
+        return np.linspace(-limit, limit, self.bins + 1)
+
+    def densities(self):
+        """
+        Return a dict with the proportion of nonzero values per histogram
+        (syncs with device).
+        """
+        if self.counts is None:
+            return {}
+        totals = self.totals.tolist()
+        zeros = self.zeros.tolist()
+        return {
+            name: 1 - zero / total
+            for name, zero, total in zip(self.names, zeros, totals)
+            if total > 0
+        }
+
+    def calibrate(self, method="percentile", percentile=99.99):
+        """
+        Return a dict with the clipping threshold (a magnitude) per
+        histogram for symmetric activation quantization:
+        - max: the largest magnitude.
+        - percentile: the magnitude below which this percentile of the
+          values are (zeros included), to the upper edge of its bin.
+        """
+        if self.counts is None:
+            return {}
+        thresholds = {}
+        counts, ranges, overflow = self.histograms()
+        zeros = self.zeros.tolist()
+        magnitudes = torch.maximum(self.min.abs(), self.max.abs()).tolist()
+        for index, name in enumerate(self.names):
+            total = zeros[index] + counts[index].sum() + overflow[index]
+            if total == 0:
+                continue
+            if method == "max":
+                thresholds[name] = magnitudes[index]
+                continue
+            half = self.bins // 2
+            edges = self.edges(None if self.log else ranges[index])
+            if self.log:
+                histogram = counts[index]
+                upper = 2.0 ** edges[1:]
+            else:
+                # Fold the bins of negative values over the positive ones
+                histogram = counts[index][half:] + counts[index][:half][::-1]
+                upper = edges[half + 1 :]
+            cumulative = zeros[index] + np.cumsum(histogram)
+            bin_index = np.searchsorted(
+                cumulative, percentile / 100 * total, side="left"
+            )
+            if bin_index < len(upper):
+                thresholds[name] = min(
+                    float(upper[bin_index]), magnitudes[index]
+                )
+            else:
+                # In the overflowing values
+                thresholds[name] = magnitudes[index]
+        return thresholds
+
+    def save(self, path):
+        """
+        Save the histograms and counts to a .npz file.
+        """
+        if self.counts is None:
+            return
+        counts, ranges, overflow = self.histograms()
+        np.savez(
+            path,
+            names=np.array(self.names),
+            counts=counts,
+            ranges=ranges if ranges is not None else [],
+            overflow=overflow,
+            zeros=self.zeros.cpu().numpy(),
+            nonfinite=self.nonfinite.cpu().numpy(),
+            totals=self.totals.cpu().numpy(),
+            min=self.min.cpu().numpy(),
+            max=self.max.cpu().numpy(),
+            log=self.log,
+            min_exp=self.min_exp,
+            max_exp=self.max_exp,
+        )
+
+    def report(self, percentile=99.99):
+        densities = self.densities()
+        thresholds = self.calibrate("percentile", percentile)
+        if self.counts is None:
+            return
+        minima = self.min.tolist()
+        maxima = self.max.tolist()
+        overflow = self.histograms()[2]
+        for index, name in enumerate(self.names):
+            if name not in densities:
+                continue
+            print(
+                "%s: min %.4f max %.4f density %.3f clip (%.2f%%) %.4f%s"
+                % (
+                    name,
+                    minima[index],
+                    maxima[index],
+                    densities[name],
+                    percentile,
+                    thresholds[name],
+                    (
+                        " overflow %d (magnitudes >= 2^%d)"
+                        % (overflow[index], self.max_exp)
+                        if overflow[index]
+                        else ""
+                    ),
+                )
+            )
@@ -17,20 +17,21 @@ import argparse
 import os
 import sys
 
-import numpy as np
-import torch
-import torchvision
-import torchvision.transforms as transforms
-
-import zs_test as test
-import zs_train as train
-import zs_train_input_transform as transform
 from config import cfg
-from models import default_base_model_path
 
-np.set_printoptions(threshold=sys.maxsize)
-torch.manual_seed(0)
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# Heavy modules (torch, torchvision, models, ...) are imported in main
+# once the arguments are parsed, and only the ones needed by the selected
+# mode, to keep the startup of short jobs (and --help) fast.
+
+# Data set splits used by each mode
+MODE_SPLITS = {
+    "train": ("train",),
+    "transform": ("train", "test"),
+    "eval": ("test",),
+    "eval-multi": ("test",),
+    "campaign": ("test",),
+    "loader-bench": ("train", "test"),
+}
 
 
 def main():
@@ -48,12 +49,19 @@ def main():
         "mode",
         help="Specify operation to perform",
         default="eval",
-        choices=["train", "transform", "eval"],
+        choices=[
+            "train",
+            "transform",
+            "eval",
+            "eval-multi",
+            "campaign",
+            "loader-bench",
+        ],
     )
     parser.add_argument(
         "dataset",
         help="Specify dataset",
-        choices=["cifar10", "mnist", "fashion"],
+        choices=["cifar10", "mnist", "fashion", "synthetic"],
         default="fashion",
     )
     group = parser.add_argument_group(
@@ -74,6 +82,116 @@ def main():
         help="Position of bit errors.",
         default=-1,
     )
+    group.add_argument(
+        "--fault-pool-size",
+        type=int,
+        help="Train against a pool of this many precomputed fault maps, "
+        "sampling one per batch (0 trains with a single fault map).",
+        default=0,
+    )
+    group.add_argument(
+        "--fault-pool-bers",
+        type=float,
+        nargs="+",
+        help="Bit error rates of the fault map pool (default: -ber).",
+        default=[],
+    )
+    group.add_argument(
+        "--fault-pool-refresh",
+        type=int,
+        help="Regenerate the fault map pool with new seeds every N epochs "
+        "(0 never regenerates it).",
+        default=0,
+    )
+    group.add_argument(
+        "--sdc",
+        action="store_true",
+        help="Compare the faulty runs (eval, eval-multi, campaign) against "
+        "the golden run of the clean model, cached per checkpoint: SDC "
+        "rate (top-1 flips) and logit deltas.",
+        default=False,
+    )
+    group.add_argument(
+        "--campaign-bers",
+        type=float,
+        nargs="+",
+        help="Bit error rates of the campaign grid (default: -ber).",
+        default=None,
+    )
+    group.add_argument(
+        "--campaign-positions",
+        type=int,
+        nargs="+",
+        help="Bit error positions of the campaign grid (default: -pos).",
+        default=None,
+    )
+    group.add_argument(
+        "--campaign-seeds",
+        type=int,
+        help="Number of fault map seeds per campaign grid point (seed, "
+        "seed + 2, ...: every map uses two consecutive seeds).",
+        default=1,
+    )
+    group.add_argument(
+        "--campaign-procs",
+        type=int,
+        help="Campaign worker processes (default: number of CPUs).",
+        default=None,
+    )
+    group.add_argument(
+        "--campaign-threads",
+        type=int,
+        help="Intra-op threads per campaign worker (default: CPUs / "
+        "processes).",
+        default=None,
+    )
+    group.add_argument(
+        "--sfi-margin",
+        type=float,
+        help="Run the campaign as an adaptive statistical fault injection: "
+        "draw fault maps per grid point until the confidence interval of "
+        "the metric is narrower than +/- this margin (0: fixed grid).",
+        default=0,
+    )
+    group.add_argument(
+        "--sfi-confidence",
+        type=float,
+        help="Confidence level of the SFI intervals.",
+        default=0.95,
+    )
+    group.add_argument(
+        "--sfi-interval",
+        help="Binomial confidence interval of the SFI campaign "
+        "(clopper-pearson needs scipy).",
+        choices=["wilson", "clopper-pearson"],
+        default="wilson",
+    )
+    group.add_argument(
+        "--sfi-metric",
+        help="Metric whose interval is checked in the SFI campaign.",
+        choices=["accuracy", "sdc_rate"],
+        default="accuracy",
+    )
+    group.add_argument(
+        "--sfi-budget",
+        type=int,
+        help="Maximum total number of runs of the SFI campaign.",
+        default=1000,
+    )
+    group.add_argument(
+        "--sfi-min-runs",
+        type=int,
+        help="Runs of every SFI point before checking its interval.",
+        default=3,
+    )
+    group.add_argument(
+        "--sfi-layer-sets",
+        nargs="+",
+        help="Faulty layer sets of the SFI grid, comma separated layer "
+        "types, e.g. conv linear conv,linear (default: the configured "
+        "faulty layers).",
+        default=None,
+    )
     group = parser.add_argument_group(
         "Initialization options", "Options to control the initial state."
     )
@@ -124,11 +242,248 @@ def main():
         help="Test batch size.",
         default=100,
     )
+    group.add_argument(
+        "--data-backend",
+        help="Data loading backend: torchvision data sets and transforms "
+        "or pre-decoded tensors augmented on device.",
+        choices=["torchvision", "tensor"],
+        default=cfg.data_backend,
+    )
+    group.add_argument(
+        "--synthetic-shape",
+        help="Image shape of the synthetic data set.",
+        choices=["cifar10", "mnist"],
+        default=cfg.synthetic_shape,
+    )
+    group.add_argument(
+        "--synthetic-size",
+        type=int,
+        help="Number of images per split of the synthetic data set.",
+        default=cfg.synthetic_size,
+    )
+    group.add_argument(
+        "--eval-fraction",
+        type=float,
+        help="Evaluate on a deterministic class-stratified subset with "
+        "this fraction of the test set.",
+        default=cfg.eval_fraction,
+    )
+    group.add_argument(
+        "--eval-samples",
+        type=int,
+        help="Evaluate on a deterministic class-stratified subset of this "
+        "many test images (takes precedence over --eval-fraction).",
+        default=cfg.eval_samples,
+    )
+    group.add_argument(
+        "--offline",
+        action="store_true",
+        help="Do not download nor verify the data sets. Fail if they are "
+        "not present.",
+        default=False,
+    )
+    group.add_argument(
+        "--workers",
+        type=int,
+        help="DataLoader worker processes (default: based on CPU count).",
+        default=cfg.num_workers,
+    )
+    group.add_argument(
+        "--pin-memory",
+        help="Use pinned memory for host to device copies "
+        "(default: auto, only for GPUs).",
+        choices=["auto", "on", "off"],
+        default="auto",
+    )
+    group.add_argument(
+        "--persistent-workers",
+        help="Keep DataLoader workers alive across epochs (default: auto, "
+        "when using workers).",
+        choices=["auto", "on", "off"],
+        default="auto",
+    )
+    group.add_argument(
+        "--prefetch-factor",
+        type=int,
+        help="Batches prefetched by each DataLoader worker (default: 2).",
+        default=cfg.prefetch_factor,
+    )
+    group.add_argument(
+        "--bench-batches",
+        type=int,
+        help="Number of batches loaded in loader-bench mode "
+        "(0: one epoch).",
+        default=0,
+    )
+    group.add_argument(
+        "--compile",
+        action="store_true",
+        help="Run the models through torch.compile (train/eval/transform).",
+        default=False,
+    )
+    group.add_argument(
+        "--compile-cache-dir",
+        help="Persistent torch.compile cache directory.",
+        default=cfg.compile_cache_dir,
+    )
+    group.add_argument(
+        "--channels-last",
+        action="store_true",
+        help="Use the channels last memory format for models and inputs.",
+        default=False,
+    )
+    group.add_argument(
+        "--eval-spec",
+        help="JSON file with the list of models (checkpoint, arch, ber, "
+        "position, seed) evaluated in eval-multi mode.",
+        default=None,
+    )
+    group.add_argument(
+        "--results",
+        help="Results file. eval: HDF5 file (.h5) where the run is "
+        "appended. eval-multi: .npz file or HDF5 file (default: "
+        "eval_multi_<arch>_<dataset>.npz in the save dir). campaign: .csv "
+        "file or HDF5 file (default: campaign_<arch>_<dataset>.csv in the "
+        "save dir, sfi_<arch>_<dataset>.csv for SFI campaigns).",
+        default=None,
+    )
+    group.add_argument(
+        "--results-worker",
+        type=int,
+        help="Worker id: write the HDF5 results to <results>.<id>.h5 "
+        "instead, to be merged afterwards (zs_results.py merge).",
+        default=None,
+    )
+    group.add_argument(
+        "--max-resident",
+        type=int,
+        help="Maximum number of models held in memory in eval-multi mode "
+        "(0: all).",
+        default=0,
+    )
+    group.add_argument(
+        "--sparsity",
+        nargs="?",
+        const="",
+        help="Report the activation sparsity (proportion of nonzero "
+        "outputs) of the ReLU and convolution modules in eval mode, "
+        "optionally only the ones whose name matches this regular "
+        "expression.",
+        default=None,
+    )
+    group.add_argument(
+        "--histograms",
+        nargs="?",
+        const="",
+        help="Collect streaming histograms of the activations and weights "
+        "of the ReLU, convolution and linear modules in eval mode "
+        "(optionally only the ones whose name matches this regular "
+        "expression), saved to the save dir, and report the derived "
+        "calibration thresholds.",
+        default=None,
+    )
+    group.add_argument(
+        "--histogram-bins",
+        type=int,
+        help="Number of bins per histogram.",
+        default=cfg.histogram_bins,
+    )
+    group.add_argument(
+        "--histogram-log",
+        action="store_true",
+        help="Use log2 magnitude bins instead of linear ones.",
+        default=cfg.histogram_log,
+    )
+    group.add_argument(
+        "--no-hooks",
+        action="store_true",
+        help="Disable all the instrumentation hooks (e.g. --sparsity, "
+        "--histograms).",
+        default=False,
+    )
+    group.add_argument(
+        "--hook-every",
+        type=int,
+        help="Run the instrumentation hooks every N batches.",
+        default=cfg.hook_every,
+    )
+    group.add_argument(
+        "--hook-first",
+        type=int,
+        help="Only run the instrumentation hooks in the first K batches "
+        "(0: all).",
+        default=cfg.hook_first,
+    )
+    group.add_argument(
+        "--hook-fraction",
+        type=float,
+        help="Run the instrumentation hooks in a random fraction of the "
+        "batches.",
+        default=cfg.hook_fraction,
+    )
+    group.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the per layer forward/backward time (split into "
+        "fault ops and compute) and memory of the model over a few "
+        "batches of train or eval mode, instead of running the mode. "
+        "Also exports a Chrome trace to the save dir.",
+        default=False,
+    )
+    group.add_argument(
+        "--profile-batches",
+        type=int,
+        help="Number of batches profiled with --profile.",
+        default=10,
+    )
+    group.add_argument(
+        "--log-every",
+        type=int,
+        help="Report throughput, loss and accuracy every N training "
+        "batches (0 only reports at the end of each epoch).",
+        default=0,
+    )
 
     args = parser.parse_args()
+
+    import numpy as np
+    import torch
+
+    import zs_data as data
+    from models import default_base_model_path
+
+    np.set_printoptions(threshold=sys.maxsize)
+    torch.manual_seed(0)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
     cfg.epochs = args.epochs
     cfg.batch_size = args.batch_size
     cfg.test_batch_size = args.test_batch_size
+    cfg.log_every = args.log_every
+    cfg.fault_pool_size = args.fault_pool_size
+    cfg.fault_pool_bers = args.fault_pool_bers
+    cfg.fault_pool_refresh = args.fault_pool_refresh
+    cfg.compile = args.compile
+    cfg.compile_cache_dir = args.compile_cache_dir
+    cfg.channels_last = args.channels_last
+    cfg.data_backend = args.data_backend
+    cfg.offline = args.offline
+    cfg.hooks_enabled = not args.no_hooks
+    cfg.hook_every = args.hook_every
+    cfg.hook_first = args.hook_first
+    cfg.hook_fraction = args.hook_fraction
+    cfg.histogram_bins = args.histogram_bins
+    cfg.histogram_log = args.histogram_log
+    cfg.eval_fraction = args.eval_fraction
+    cfg.eval_samples = args.eval_samples
+    cfg.synthetic_shape = args.synthetic_shape
+    cfg.synthetic_size = args.synthetic_size
+    cfg.num_workers = args.workers
+    cfg.pin_memory = {"auto": None, "on": True, "off": False}[args.pin_memory]
+    cfg.persistent_workers = {"auto": None, "on": True, "off": False}[
+        args.persistent_workers
+    ]
+    cfg.prefetch_factor = args.prefetch_factor
 
     if not os.path.exists(cfg.save_dir):
         os.makedirs(cfg.save_dir)
@@ -137,123 +492,31 @@ def main():
     #    print('ERROR: specified bit position for error exceeds the precision')
     #    exit(0)
 
-    print("Preparing data..", args.dataset)
-    if args.dataset == "cifar10":
-        dataset = "cifar"
-        in_channels = 3
-        transform_train = transforms.Compose(
-            [
-                transforms.RandomCrop(32, padding=4),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                transforms.Lambda(lambda t: t * 2 - 1),
-            ]
-        )
-
-        transform_test = transforms.Compose(
-            [
-                transforms.ToTensor(),
-                transforms.Lambda(lambda t: t * 2 - 1),
-            ]
-        )
-
-        trainset = torchvision.datasets.CIFAR10(
-            root=cfg.data_dir,
-            train=True,
-            download=True,
-            transform=transform_train,
-        )
-        trainloader = torch.utils.data.DataLoader(
-            trainset, batch_size=cfg.batch_size, shuffle=True, num_workers=2
-        )
-
-        testset = torchvision.datasets.CIFAR10(
-            root=cfg.data_dir,
-            train=False,
-            download=True,
-            transform=transform_test,
-        )
-        testloader = torch.utils.data.DataLoader(
-            testset,
-            batch_size=cfg.test_batch_size,
-            shuffle=False,
-            num_workers=2,
-        )
-
-    elif args.dataset == "mnist":
-        dataset = "mnist"
-        in_channels = 1
-        transform_train = transforms.Compose(
-            [transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))]
-        )
-        transform_test = transforms.Compose(
-            [transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))]
-        )
-
-        trainset = torchvision.datasets.MNIST(
-            root=cfg.data_dir,
-            train=True,
-            download=True,
-            transform=transform_train,
-        )
-        trainloader = torch.utils.data.DataLoader(
-            trainset, batch_size=cfg.batch_size, shuffle=True, num_workers=2
-        )
-
-        testset = torchvision.datasets.MNIST(
-            root=cfg.data_dir,
-            train=False,
-            download=True,
-            transform=transform_test,
-        )
-        testloader = torch.utils.data.DataLoader(
-            testset,
-            batch_size=cfg.test_batch_size,
-            shuffle=False,
-            num_workers=2,
-        )
-
-    else:
-        dataset = "fashion"
-        in_channels = 1
-        transform_train = transforms.Compose(
-            [
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    (0.2860,), (0.3530,)
-                ),  # per channel means and std devs
-            ]
-        )
+    print("Device", device)
+    cfg.device = device
 
-        transform_test = transforms.Compose(
-            [transforms.ToTensor(), transforms.Normalize((0.2868,), (0.3524,))]
+    print("Preparing data..", args.dataset)
+    try:
+        dataset, in_channels, trainloader, testloader = data.get_loaders(
+            args.dataset, device, MODE_SPLITS[args.mode]
         )
+    except FileNotFoundError as err:
+        print("ERROR:", err)
+        sys.exit(1)
 
-        trainset = torchvision.datasets.FashionMNIST(
-            root=cfg.data_dir,
-            train=True,
-            download=True,
-            transform=transform_train,
-        )
-        trainloader = torch.utils.data.DataLoader(
-            trainset, batch_size=cfg.batch_size, shuffle=True, num_workers=2
-        )
+    if args.results is not None and args.results_worker is not None:
+        import zs_results
 
-        testset = torchvision.datasets.FashionMNIST(
-            root=cfg.data_dir,
-            train=False,
-            download=True,
-            transform=transform_test,
-        )
-        testloader = torch.utils.data.DataLoader(
-            testset,
-            batch_size=cfg.test_batch_size,
-            shuffle=False,
-            num_workers=2,
+        args.results = zs_results.worker_path(
+            args.results, args.results_worker
         )
 
-    print("Device", device)
-    cfg.device = device
+    if args.mode == "loader-bench":
+        print("Train loader")
+        data.loader_benchmark(trainloader, device, args.bench_batches)
+        print("Test loader")
+        data.loader_benchmark(testloader, device, args.bench_batches)
+        return
 
     assert isinstance(cfg.faulty_layers, list)
 
@@ -292,7 +555,35 @@ def main():
             )
         )
 
+    if args.profile:
+        if args.mode not in ("train", "eval"):
+            print("ERROR: --profile is only supported in train and eval modes")
+            sys.exit(1)
+        import zs_profile
+
+        zs_profile.profile(
+            trainloader if args.mode == "train" else testloader,
+            args.arch,
+            dataset,
+            in_channels,
+            cfg.precision,
+            args.checkpoint,
+            device,
+            cfg.faulty_layers,
+            args.bit_error_rate,
+            args.position,
+            train=args.mode == "train",
+            steps=args.profile_batches,
+            trace_path=os.path.join(
+                cfg.save_dir,
+                "profile_%s_%s_%s.json" % (args.arch, dataset, args.mode),
+            ),
+        )
+        return
+
     if args.mode == "train":
+        import zs_train as train
+
         print("training args", args)
         train.training(
             trainloader,
@@ -309,6 +600,8 @@ def main():
             args.position,
         )
     elif args.mode == "transform":
+        import zs_train_input_transform as transform
+
         print("input_transform_train", args)
         transform.transform_train(
             trainloader,
@@ -325,6 +618,25 @@ def main():
             args.position,
         )
     elif args.mode == "eval":
+        import zs_golden
+        import zs_test as test
+
+        golden = None
+        if args.sdc:
+            try:
+                golden = zs_golden.golden_outputs(
+                    testloader,
+                    args.arch,
+                    dataset,
+                    in_channels,
+                    cfg.precision,
+                    args.checkpoint,
+                    device,
+                )
+            except FileNotFoundError as err:
+                print("ERROR: --sdc needs the checkpoint of the run:", err)
+                sys.exit(1)
+
         print("test model", args)
         test.inference(
             testloader,
@@ -337,6 +649,100 @@ def main():
             cfg.faulty_layers,
             args.bit_error_rate,
             args.position,
+            seed=cfg.seed,
+            results_path=args.results,
+            golden=golden,
+            sparsity=args.sparsity,
+            histograms=args.histograms,
+        )
+    elif args.mode == "eval-multi":
+        import zs_test as test
+
+        if args.eval_spec is None:
+            parser.error("eval-multi mode requires --eval-spec")
+        if args.results is None:
+            args.results = os.path.join(
+                cfg.save_dir,
+                "eval_multi_%s_%s.npz" % (args.arch, dataset),
+            )
+        configs = test.read_eval_spec(
+            args.eval_spec,
+            args.arch,
+            dataset,
+            cfg.precision,
+            args.bit_error_rate,
+            args.position,
+        )
+        test.inference_multi(
+            testloader,
+            configs,
+            dataset,
+            in_channels,
+            cfg.precision,
+            device,
+            cfg.faulty_layers,
+            args.results,
+            args.max_resident,
+            args.sdc,
+        )
+    elif args.mode == "campaign":
+        import zs_campaign as campaign
+
+        if args.results is None:
+            args.results = os.path.join(
+                cfg.save_dir,
+                "%s_%s_%s.csv"
+                % (
+                    "sfi" if args.sfi_margin > 0 else "campaign",
+                    args.arch,
+                    dataset,
+                ),
+            )
+        procs = args.campaign_procs or os.cpu_count()
+        threads = args.campaign_threads or max(1, os.cpu_count() // procs)
+        if args.sfi_margin > 0:
+            layer_sets = [
+                layers.split(",")
+                for layers in args.sfi_layer_sets
+                or [",".join(cfg.faulty_layers)]
+            ]
+            campaign.sfi_campaign(
+                testloader,
+                args.arch,
+                dataset,
+                in_channels,
+                cfg.precision,
+                args.checkpoint,
+                layer_sets,
+                args.campaign_bers or [args.bit_error_rate],
+                args.campaign_positions or [args.position],
+                procs,
+                threads,
+                args.results,
+                metric=args.sfi_metric,
+                margin=args.sfi_margin,
+                confidence=args.sfi_confidence,
+                budget=args.sfi_budget,
+                min_runs=args.sfi_min_runs,
+                method=args.sfi_interval,
+            )
+            return
+        campaign.campaign(
+            testloader,
+            args.arch,
+            dataset,
+            in_channels,
+            cfg.precision,
+            args.checkpoint,
+            cfg.faulty_layers,
+            args.campaign_bers or [args.bit_error_rate],
+            args.campaign_positions or [args.position],
+            # A fault map uses seed and seed + 1 (see RandomFaultModel)
+            range(cfg.seed, cfg.seed + 2 * args.campaign_seeds, 2),
+            procs,
+            threads,
+            args.results,
+            args.sdc,
         )
     else:
         raise NotImplementedError
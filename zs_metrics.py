@@ -0,0 +1,114 @@
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import time
+from statistics import NormalDist
+
+import torch
+
+__all__ = ["RunningMetrics", "binomial_interval"]
+
+
+class RunningMetrics:
+    """
+    Accumulate the running loss and the correct prediction counts of a
+    training loop in on-device tensors. Values are only copied back to the
+    host (forcing a device sync) when they are logged or read. Losses are
+    reported as the mean batch loss (total / batches).
+    """
+
+    def __init__(self, device, names=("accuracy",), log_every=0):
+        """
+        :param device: The device where the metrics are accumulated.
+        :param names: The names of the accuracies (one per correct count
+                      passed to update).
+        :param log_every: An int. Report throughput, loss and accuracies
+                          every log_every batches (0 disables it).
+        """
+        self.names = list(names)
+        self.log_every = log_every
+        self.totals = torch.zeros(
+            len(self.names) + 1, dtype=torch.float64, device=device
+        )
+        self.samples = 0
+        self.batches = 0
+        self._log_time = time.perf_counter()
+        self._log_samples = 0
+
+    def update(self, batch_size, loss, *correct):
+        self.totals[0].add_(loss.detach())
+        for i, count in enumerate(correct, 1):
+            self.totals[i].add_(count)
+        self.samples += batch_size
+        self.batches += 1
+        if self.log_every > 0 and self.batches % self.log_every == 0:
+            self.log()
+
+    def values(self):
+        """
+        Return the accumulated loss and correct counts (syncs with device).
+        """
+        return self.totals.tolist()
+
+    def log(self):
+        totals = self.values()
+        now = time.perf_counter()
+        throughput = (self.samples - self._log_samples) / (
+            now - self._log_time
+        )
+        self._log_time = now
+        self._log_samples = self.samples
+
+        accuracies = ", ".join(
+            "{}: {:.5f}".format(name, count / self.samples)
+            for name, count in zip(self.names, totals[1:])
+        )
+        print(
+            "Batch: {}, images/s: {:.1f}, loss: {:.6f}, {}".format(
+                self.batches, throughput, totals[0] / self.batches, accuracies
+            )
+        )
+
+
+def binomial_interval(successes, trials, confidence=0.95, method="wilson"):
+    """
+    Confidence interval of a binomial proportion. Returns (low, high).
+
+    :param method: "wilson" (score interval) or "clopper-pearson" (exact,
+                   needs scipy).
+    """
+    if trials == 0:
+        return 0.0, 1.0
+    if method == "clopper-pearson":
+        from scipy.stats import beta
+
+        alpha = 1 - confidence
+        low = beta.ppf(alpha / 2, successes, trials - successes + 1)
+        high = beta.isf(alpha / 2, successes + 1, trials - successes)
+        return (
+            0.0 if successes == 0 else float(low),
+            1.0 if successes == trials else float(high),
+        )
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    center = (p + z * z / (2 * trials)) / denominator
+    half = (
+        z
+        * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials))
+        / denominator
+    )
+    return center - half, center + half
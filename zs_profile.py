@@ -0,0 +1,273 @@
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per layer latency and memory profiling of the (fault injected) models.
+
+The forward and backward wall time of every leaf module is measured with
+pre and post hooks, and the time of the fault ops (fault map generation
+and injection, see faultinjection_ops) is measured apart so that it can
+be split from the compute time of the layer. Peak allocated memory per
+module is recorded on GPUs (output size on CPUs). The same steps are
+recorded by torch.profiler, with the modules and fault ops labeled, and
+exported as a Chrome trace.
+"""
+
+import collections
+import contextlib
+import functools
+import time
+
+import torch
+from torch import nn
+
+from config import cfg
+from faultinjection_ops import zs_faultinjection_ops
+from models import init_models_faulty, memory_format
+
+__all__ = ["ModuleProfiler", "profile"]
+
+
+class ModuleProfiler:
+    """
+    Measure the forward/backward time and memory of the leaf modules of a
+    model and the time of their fault ops.
+    """
+
+    def __init__(self, model):
+        self.cuda = torch.cuda.is_available() and any(
+            param.is_cuda for param in model.parameters()
+        )
+        self.names = {}
+        self.handles = []
+        self.forward_time = collections.defaultdict(float)
+        self.backward_time = collections.defaultdict(float)
+        self.fault_time = collections.defaultdict(float)
+        self.memory = collections.defaultdict(int)
+        self.calls = collections.defaultdict(int)
+        self._start = {}
+        self._labels = {}
+
+        for name, module in model.named_modules():
+            if len(list(module.children())) > 0:
+                continue
+            self.names[module] = name
+            self.handles.append(
+                module.register_forward_pre_hook(self.forward_pre_hook)
+            )
+            self.handles.append(
+                module.register_forward_hook(self.forward_hook)
+            )
+
+    def __enter__(self):
+        zs_faultinjection_ops.fault_op_context = self.fault_op
+        return self
+
+    def __exit__(self, *exc):
+        zs_faultinjection_ops.fault_op_context = None
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def now(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def forward_pre_hook(self, module, input):
+        name = self.names[module]
+        label = torch.autograd.profiler.record_function(name)
+        label.__enter__()
+        self._labels[module] = label
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+            self._start[module, "memory"] = torch.cuda.memory_allocated()
+        self._start[module] = self.now()
+
+    def forward_hook(self, module, input, output):
+        name = self.names[module]
+        self.forward_time[name] += self.now() - self._start.pop(module)
+        self.calls[name] += 1
+        if self.cuda:
+            self.memory[name] = max(
+                self.memory[name],
+                torch.cuda.max_memory_allocated()
+                - self._start.pop((module, "memory")),
+            )
+        elif isinstance(output, torch.Tensor):
+            self.memory[name] = max(
+                self.memory[name], output.numel() * output.element_size()
+            )
+        self._labels.pop(module).__exit__(None, None, None)
+        # The backward time is measured on the autograd node of the output
+        # rather than with module backward hooks, which break on the in
+        # place ops of the models (e.g. the residual additions)
+        if (
+            isinstance(output, torch.Tensor)
+            and output.grad_fn is not None
+            # Identities (e.g. empty shortcuts) return their input
+            and not any(output is tensor for tensor in input)
+        ):
+            node = output.grad_fn
+            node.register_prehook(
+                functools.partial(self.backward_pre_hook, module)
+            )
+            node.register_hook(functools.partial(self.backward_hook, module))
+
+    def backward_pre_hook(self, module, grad_output):
+        self._start[module, "backward"] = self.now()
+
+    def backward_hook(self, module, grad_input, grad_output):
+        name = self.names[module]
+        start = self._start.pop((module, "backward"), None)
+        if start is not None:
+            self.backward_time[name] += self.now() - start
+
+    @contextlib.contextmanager
+    def fault_op(self, module, op):
+        name = "%s.%s" % (self.names.get(module, "?"), op)
+        with torch.autograd.profiler.record_function(name):
+            start = self.now()
+            yield
+            self.fault_time[name] += self.now() - start
+
+    def report(self, steps):
+        """
+        Print the per module summary table (times per step, in ms).
+        """
+        print(
+            "%-32s %12s %12s %12s %12s %12s"
+            % (
+                "module",
+                "forward",
+                "fault ops",
+                "compute",
+                "backward",
+                "memory (MB)",
+            )
+        )
+        totals = collections.defaultdict(float)
+        for name in self.forward_time:
+            fault = sum(
+                self.fault_time.get("%s.%s" % (name, op), 0.0)
+                for op in ("fault_map", "fault_inject")
+            )
+            row = {
+                "forward": self.forward_time[name],
+                "fault ops": fault,
+                "compute": self.forward_time[name] - fault,
+                "backward": self.backward_time.get(name, 0.0),
+            }
+            for key, value in row.items():
+                totals[key] += value
+            print(
+                "%-32s %12.3f %12.3f %12.3f %12.3f %12.3f"
+                % (
+                    (name,)
+                    + tuple(value * 1e3 / steps for value in row.values())
+                    + (self.memory[name] / 2**20,)
+                )
+            )
+        print(
+            "%-32s %12.3f %12.3f %12.3f %12.3f"
+            % (
+                ("total",)
+                + tuple(value * 1e3 / steps for value in totals.values())
+            )
+        )
+
+
+def profile(
+    loader,
+    arch,
+    dataset,
+    in_channels,
+    precision,
+    checkpoint_path,
+    device,
+    faulty_layers,
+    ber,
+    position,
+    train=False,
+    steps=10,
+    trace_path=None,
+):
+    """
+    Profile steps batches of training (forward, backward and optimizer
+    step) or evaluation of a model. Prints the per module summary and the
+    torch.profiler operator table, and exports the Chrome trace to
+    trace_path.
+    """
+    model, _ = init_models_faulty(
+        arch,
+        in_channels,
+        precision,
+        True,
+        checkpoint_path,
+        faulty_layers,
+        ber,
+        position,
+        model_only=True,
+    )
+    mformat = memory_format()
+    model = model.to(device, memory_format=mformat)
+    model.train(train)
+    opt = torch.optim.SGD(model.parameters(), lr=cfg.learning_rate)
+    criterion = nn.CrossEntropyLoss()
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def step(inputs, classes):
+        inputs = inputs.to(device, memory_format=mformat, non_blocking=True)
+        classes = classes.to(device, non_blocking=True)
+        if train:
+            opt.zero_grad()
+            loss = criterion(model(inputs), classes)
+            loss.backward()
+            opt.step()
+        else:
+            with torch.no_grad():
+                model(inputs)
+
+    batches = iter(loader)
+    # Warm up outside of the measurements
+    step(*next(batches))
+
+    done = 0
+    with ModuleProfiler(model) as profiler, torch.profiler.profile(
+        activities=activities, profile_memory=True
+    ) as torch_profiler:
+        for inputs, classes in batches:
+            if done == steps:
+                break
+            step(inputs, classes)
+            done += 1
+
+    print(
+        "Profiled %d %s steps of %s (batch size %d)"
+        % (done, "training" if train else "eval", arch, loader.batch_size)
+    )
+    profiler.report(max(done, 1))
+    sort_by = (
+        "self_cuda_time_total"
+        if torch.cuda.is_available()
+        else "self_cpu_time_total"
+    )
+    print(torch_profiler.key_averages().table(sort_by=sort_by, row_limit=20))
+    if trace_path is not None:
+        torch_profiler.export_chrome_trace(trace_path)
+        print("Chrome trace saved to", trace_path)
+    return profiler
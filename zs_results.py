@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# Copyright 2022 IBM Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+File: zs_results.py
+
+HDF5 results files of evaluation runs.
+
+Every run is stored as a group /runs/<key>, where the key is built from
+its (arch, dataset, ber, position, seed, faulty layers, checkpoint file
+name), with chunked and compressed
+per sample datasets (confidences, confidence_diffs, predictions, logits)
+and the run parameters and accuracy as attributes. The /index table
+(one row per run) allows listing and filtering the runs without opening
+their groups.
+
+A file must only be written by a single process: concurrent workers
+write one file each (see worker_path) and the files are merged
+afterwards (merge, or the merge command of this script).
+"""
+
+# Built-in modules
+import argparse
+import os
+import sys
+
+# Third party modules
+import h5py
+import numpy as np
+
+# Constants
+
+RECORDS = ["confidences", "confidence_diffs", "predictions", "logits"]
+
+# Variable length strings, so that long keys and checkpoint names are not
+# truncated
+INDEX_DTYPE = np.dtype(
+    [
+        ("key", h5py.string_dtype()),
+        ("arch", h5py.string_dtype()),
+        ("dataset", h5py.string_dtype()),
+        ("ber", "f8"),
+        ("position", "i4"),
+        ("seed", "i8"),
+        ("faulty_layers", h5py.string_dtype()),
+        ("checkpoint", h5py.string_dtype()),
+        ("accuracy", "f8"),
+    ]
+)
+
+# Functions
+
+
+def layers_id(faulty_layers):
+    if isinstance(faulty_layers, str):
+        return faulty_layers
+    return "-".join(faulty_layers or [])
+
+
+def checkpoint_id(checkpoint):
+    return os.path.basename(checkpoint or "")
+
+
+def run_key(arch, dataset, ber, position, seed, faulty_layers, checkpoint):
+    """
+    Return the key of a run. The checkpoint is identified by its file
+    name, so runs of different checkpoints (e.g. epochs) do not replace
+    each other.
+    """
+    return "%s_%s_ber_%.6e_pos_%d_seed_%d_fl_%s_ckpt_%s" % (
+        arch,
+        dataset,
+        ber,
+        position,
+        seed,
+        layers_id(faulty_layers) or "none",
+        checkpoint_id(checkpoint) or "none",
+    )
+
+
+def params_key(params):
+    return run_key(
+        params["arch"],
+        params["dataset"],
+        params["ber"],
+        params["position"],
+        params["seed"],
+        params.get("faulty_layers"),
+        params.get("checkpoint"),
+    )
+
+
+def worker_path(path, worker):
+    """
+    Return the results file of a worker: results.h5 -> results.<worker>.h5
+    """
+    base, ext = os.path.splitext(path)
+    return "%s.%d%s" % (base, worker, ext)
+
+
+class ResultsWriter:
+    """
+    Append runs to an HDF5 results file as they complete.
+    """
+
+    def __init__(self, path, compression="gzip", chunk_size=4096):
+        """
+        :param path: The HDF5 file, created if it does not exist.
+        :param compression: The HDF5 compression filter of the records.
+        :param chunk_size: An int. Number of samples per chunk.
+        """
+        self.path = path
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.file = h5py.File(path, "a")
+        if "index" in self.file and self.file["index"].dtype != INDEX_DTYPE:
+            self.file.close()
+            raise ValueError(
+                "%s was written by an older version (different index "
+                "columns)" % path
+            )
+        if "index" not in self.file:
+            self.file.create_dataset(
+                "index",
+                shape=(0,),
+                maxshape=(None,),
+                dtype=INDEX_DTYPE,
+                chunks=True,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def append(self, params, accuracy, records):
+        """
+        Store a run. A run with the same key is replaced.
+
+        :param params: A dict with the arch, dataset, ber, position,
+                       seed, faulty_layers and checkpoint of the run (and
+                       optionally more attributes). None values are not
+                       stored.
+        :param accuracy: A float. The run accuracy.
+        :param records: A dict of per sample numpy arrays (see RECORDS).
+        """
+        key = params_key(params)
+        self.remove(key)
+
+        group = self.file.create_group("runs/" + key)
+        for name, data in records.items():
+            data = np.asarray(data)
+            group.create_dataset(
+                name,
+                data=data,
+                chunks=(min(self.chunk_size, max(len(data), 1)),)
+                + data.shape[1:],
+                compression=self.compression,
+                shuffle=True,
+            )
+        for name, value in params.items():
+            if value is None:
+                continue
+            if name == "faulty_layers":
+                value = layers_id(value)
+            group.attrs[name] = value
+        group.attrs["accuracy"] = accuracy
+
+        index = self.file["index"]
+        index.resize((len(index) + 1,))
+        index[-1] = (
+            key,
+            params["arch"],
+            params["dataset"],
+            params["ber"],
+            params["position"],
+            params["seed"],
+            layers_id(params.get("faulty_layers")),
+            checkpoint_id(params.get("checkpoint")),
+            accuracy,
+        )
+        self.file.flush()
+
+    def remove(self, key):
+        if "runs/" + key not in self.file:
+            return
+        del self.file["runs/" + key]
+        index = self.file["index"][:]
+        index = index[index["key"] != key.encode()]
+        self.file["index"].resize((len(index),))
+        self.file["index"][:] = index
+
+
+def read_index(path):
+    """
+    Return the index table of a results file as a numpy structured array.
+    """
+    with h5py.File(path, "r") as results:
+        return results["index"][:]
+
+
+def lookup(
+    path, arch, dataset, ber, position, seed, faulty_layers, checkpoint
+):
+    """
+    Return the records and attributes of a run, None if not present.
+    """
+    key = run_key(
+        arch, dataset, ber, position, seed, faulty_layers, checkpoint
+    )
+    with h5py.File(path, "r") as results:
+        if "runs/" + key not in results:
+            return None
+        group = results["runs/" + key]
+        run = dict(group.attrs)
+        for name in group:
+            run[name] = group[name][:]
+        return run
+
+
+def merge(paths, out_path):
+    """
+    Merge results files (e.g. one per worker) into out_path. Later files
+    replace the runs with the same key of earlier ones.
+    """
+    with ResultsWriter(out_path) as writer:
+        runs = writer.file.require_group("runs")
+        for path in paths:
+            with h5py.File(path, "r") as results:
+                for row in results["index"][:]:
+                    key = row["key"].decode()
+                    writer.remove(key)
+                    results.copy(results["runs/" + key], runs)
+                    index = writer.file["index"]
+                    index.resize((len(index) + 1,))
+                    index[-1] = row
+        writer.file.flush()
+
+
+def info(msg):
+    print("zs_results: %s" % str(msg))
+
+
+def main():
+    """
+    Program main
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    merge_parser = subparsers.add_parser("merge", help="Merge results files.")
+    merge_parser.add_argument("output", help="Merged results file.")
+    merge_parser.add_argument("inputs", nargs="+", help="Results files.")
+    index_parser = subparsers.add_parser(
+        "index", help="Print the index of a results file."
+    )
+    index_parser.add_argument("results", help="Results file.")
+    args = parser.parse_args()
+
+    if args.command == "merge":
+        merge(args.inputs, args.output)
+        info(
+            "merged %d files, %d runs"
+            % (len(args.inputs), len(read_index(args.output)))
+        )
+    elif args.command == "index":
+        print(
+            "%-8s %-16s %12s %8s %8s %-12s %10s  %s"
+            % (
+                "arch",
+                "dataset",
+                "ber",
+                "position",
+                "seed",
+                "layers",
+                "accuracy",
+                "checkpoint",
+            )
+        )
+        for row in read_index(args.results):
+            print(
+                "%-8s %-16s %12.3e %8d %8d %-12s %10.4f  %s"
+                % (
+                    row["arch"].decode(),
+                    row["dataset"].decode(),
+                    row["ber"],
+                    row["position"],
+                    row["seed"],
+                    row["faulty_layers"].decode(),
+                    row["accuracy"],
+                    row["checkpoint"].decode(),
+                )
+            )
+    sys.exit(0)
+
+
+# Main
+
+if __name__ == "__main__":  # run main if executed from the command line
+    # and the main method exists
+
+    if callable(locals().get("main")):
+        main()
+        sys.exit(0)
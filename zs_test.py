@@ -12,10 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import time
+
+import numpy as np
 import torch
 
 import zs_hooks_stats as stats
-from models import init_models_faulty
+from config import cfg
+from models import (
+    compile_model,
+    default_base_model_path,
+    init_models_faulty,
+    memory_format,
+)
+from zs_golden import SDCMetrics, golden_outputs
+from zs_metrics import binomial_interval
 
 debug = False
 visualize = False
@@ -32,7 +45,23 @@ def inference(
     faulty_layers,
     ber,
     position,
+    seed=0,
+    results_path=None,
+    golden=None,
+    sparsity=None,
+    histograms=None,
 ):
+    """
+    Evaluate a model. If results_path is given, the run (per sample
+    records, accuracy and parameters) is appended to that HDF5 results
+    file (see zs_results). If the golden run (logits, labels) of the
+    checkpoint is given (see zs_golden), the SDC metrics are computed too.
+    If sparsity is given, the activation sparsity of the modules whose
+    name matches that regular expression is reported. If histograms is
+    given, the histograms of the activations and weights of the modules
+    whose name matches that regular expression are collected, saved to
+    the save dir and the derived calibration thresholds are reported.
+    """
     model, checkpoint_epoch = init_models_faulty(
         arch,
         in_channels,
@@ -42,33 +71,42 @@ def inference(
         faulty_layers,
         ber,
         position,
+        seed=seed,
+        model_only=True,
     )
 
-    if arch == "resnet18" or arch == "resnet34":
-        stats.resnet_register_hooks(model, arch)
-    elif arch == "vgg16" or arch == "vgg11":
-        stats.vgg_register_hooks(model, arch)
-    else:
-        print("Inspection/Results hooks not implemented for: %s" % arch)
+    hooks = stats.HookManager()
+    profiler = None
+    if sparsity is not None:
+        profiler = stats.SparsityProfiler(model, sparsity, manager=hooks)
+    collector = None
+    if histograms is not None:
+        collector = stats.HistogramCollector(model, histograms, manager=hooks)
 
-    logger = stats.DataLogger(
-        int(len(testloader.dataset) / testloader.batch_size),
-        testloader.batch_size,
-    )
+    logger = stats.DataLogger(len(testloader.dataset), device)
 
-    model = model.to(device)
     # model = torch.nn.DataParallel(model)
     torch.backends.cudnn.benchmark = True
 
     model.eval()
 
-    model = model.to(device)
+    mformat = memory_format()
+    model = model.to(device, memory_format=mformat)
+    if cfg.compile:
+        model = compile_model(model, cfg.compile_cache_dir)
     running_correct = 0.0
+    sdc = None
+    if golden is not None:
+        sdc = SDCMetrics(*golden)
 
+    start = time.perf_counter()
     with torch.no_grad():
         for t, (inputs, classes) in enumerate(testloader):
-            inputs = inputs.to(device)
-            classes = classes.to(device)
+            hooks.step()
+            inputs = inputs.to(
+                device, memory_format=mformat, non_blocking=True
+            )
+            classes = classes.to(device, non_blocking=True)
             model_outputs = model(inputs)
             # pdb.set_trace()
             lg, preds = torch.max(model_outputs, 1)
@@ -76,8 +114,251 @@ def inference(
             running_correct += correct
 
             logger.update(model_outputs)
+            if sdc is not None:
+                sdc.update(model_outputs)
 
+    num_samples = len(testloader.dataset)
+    correct = int(running_correct)
+    eval_time = time.perf_counter() - start
+    accuracy = correct / num_samples
+    low, high = binomial_interval(correct, num_samples)
+    print("Eval Accuracy %.3f" % accuracy)
     print(
-        "Eval Accuracy %.3f"
-        % (running_correct.double() / (len(testloader.dataset)))
+        "Accuracy 95%% confidence interval [%.3f, %.3f] (%d samples)"
+        % (low, high, num_samples)
     )
+    if sdc is not None:
+        sdc.log()
+    if profiler is not None:
+        profiler.report()
+    if collector is not None:
+        collector.report()
+        histograms_path = os.path.join(
+            cfg.save_dir, "histograms_%s_%s.npz" % (arch, dataset)
+        )
+        collector.save(histograms_path)
+        print("Histograms saved to", histograms_path)
+    if profiler is not None or collector is not None:
+        hooks.report(eval_time)
+    hooks.remove()
+
+    if results_path is not None:
+        import zs_results
+
+        params = {
+            "arch": arch,
+            "dataset": dataset,
+            "ber": ber,
+            "position": position,
+            "seed": seed,
+            "faulty_layers": faulty_layers,
+            "checkpoint": checkpoint_path,
+            "accuracy_low": low,
+            "accuracy_high": high,
+        }
+        if sdc is not None:
+            params.update(sdc.values())
+        with zs_results.ResultsWriter(results_path) as writer:
+            logger.write(writer, params, accuracy)
+        print("Results saved to", results_path)
+    else:
+        logger.finalize()
+
+
+def read_eval_spec(spec_path, arch, dataset, precision, ber, position):
+    """
+    Read the models to evaluate from a JSON file with a list of entries
+    with the optional keys: checkpoint, arch, ber, position and seed.
+    Missing keys take the command line values (the checkpoint defaults to
+    the base model path of the entry).
+    """
+    with open(spec_path) as spec_file:
+        entries = json.load(spec_file)
+
+    configs = []
+    for entry in entries:
+        config = {
+            "arch": entry.get("arch", arch),
+            "ber": entry.get("ber", ber),
+            "position": entry.get("position", position),
+            "seed": entry.get("seed", cfg.seed),
+        }
+        config["checkpoint"] = entry.get(
+            "checkpoint",
+            default_base_model_path(
+                cfg.data_dir,
+                config["arch"],
+                dataset,
+                precision,
+                cfg.faulty_layers,
+                config["ber"],
+                config["position"],
+            ),
+        )
+        configs.append(config)
+    return configs
+
+
+def host_batch(tensor):
+    """
+    Return a batch tensor on the host, pinned with CUDA so that it can be
+    copied back to device asynchronously.
+    """
+    tensor = tensor.cpu()
+    if torch.cuda.is_available() and not tensor.is_pinned():
+        tensor = tensor.pin_memory()
+    return tensor
+
+
+def inference_multi(
+    testloader,
+    configs,
+    dataset,
+    in_channels,
+    precision,
+    device,
+    faulty_layers,
+    results_path,
+    max_resident=0,
+    sdc=False,
+):
+    """
+    Evaluate several models (checkpoint and fault configuration) in a
+    single pass over the test set: every batch is run through all the
+    models.
+
+    :param configs: A list of dicts (see read_eval_spec).
+    :param results_path: The .npz file where the per model accuracy and
+                         logits, the labels and the configurations are
+                         saved, or an HDF5 results file (.h5, see
+                         zs_results) where a run is appended per model.
+    :param max_resident: An int. Maximum number of models held in memory
+                         at once (0: all). Models are then evaluated in
+                         groups and the test batches are cached on the
+                         host (pinned with CUDA) after the first pass,
+                         and copied to device for every group.
+    :param sdc: A boolean. Compare every model against the golden run of
+                its checkpoint (see zs_golden).
+    """
+    group_size = max_resident if max_resident > 0 else len(configs)
+    mformat = memory_format()
+    torch.backends.cudnn.benchmark = True
+
+    batches = None
+    logits = [None] * len(configs)
+    labels = None
+    for first in range(0, len(configs), group_size):
+        group = range(first, min(first + group_size, len(configs)))
+        models = []
+        for i in group:
+            print("Loading model %d: %s" % (i, configs[i]))
+            model, _ = init_models_faulty(
+                configs[i]["arch"],
+                in_channels,
+                precision,
+                True,
+                configs[i]["checkpoint"],
+                faulty_layers,
+                configs[i]["ber"],
+                configs[i]["position"],
+                seed=configs[i]["seed"],
+                model_only=True,
+            )
+            model = model.to(device, memory_format=mformat)
+            model.eval()
+            if cfg.compile:
+                model = compile_model(model, cfg.compile_cache_dir)
+            models.append(model)
+
+        # Only keep the test set in memory when it is read more than once
+        cache = batches is None and len(group) < len(configs)
+        source = testloader if batches is None else batches
+        if cache:
+            batches = []
+        outputs = [[] for _ in group]
+        group_labels = []
+        with torch.no_grad():
+            for inputs, classes in source:
+                if cache:
+                    batches.append((host_batch(inputs), host_batch(classes)))
+                inputs = inputs.to(
+                    device, memory_format=mformat, non_blocking=True
+                )
+                classes = classes.to(device, non_blocking=True)
+                group_labels.append(classes)
+                for model, model_outputs in zip(models, outputs):
+                    model_outputs.append(model(inputs))
+
+        labels = torch.cat(group_labels)
+        for i, model_outputs in zip(group, outputs):
+            logits[i] = torch.cat(model_outputs)
+        del models
+
+    logits = torch.stack(logits)
+    accuracy = (logits.argmax(2) == labels).double().mean(1).cpu().numpy()
+    for config, acc in zip(configs, accuracy):
+        print(
+            "Eval Accuracy %.3f %s ber %.3e pos %d seed %d %s"
+            % (
+                acc,
+                config["arch"],
+                config["ber"],
+                config["position"],
+                config["seed"],
+                config["checkpoint"],
+            )
+        )
+
+    metrics = [{} for _ in configs]
+    if sdc:
+        for config, model_logits, model_metrics in zip(
+            configs, logits, metrics
+        ):
+            golden = golden_outputs(
+                testloader,
+                config["arch"],
+                dataset,
+                in_channels,
+                precision,
+                config["checkpoint"],
+                device,
+            )
+            sdc_metrics = SDCMetrics(*golden)
+            sdc_metrics.update(model_logits)
+            sdc_metrics.log()
+            model_metrics.update(sdc_metrics.values())
+
+    if results_path.endswith(".h5"):
+        import zs_results
+
+        with zs_results.ResultsWriter(results_path) as writer:
+            for config, acc, model_logits, model_metrics in zip(
+                configs, accuracy, logits, metrics
+            ):
+                logger = stats.DataLogger(len(labels), device)
+                logger.update(model_logits)
+                params = dict(
+                    config,
+                    dataset=dataset,
+                    faulty_layers=faulty_layers,
+                    **model_metrics,
+                )
+                logger.write(writer, params, float(acc))
+    else:
+        np.savez(
+            results_path,
+            accuracy=accuracy,
+            logits=logits.cpu().numpy(),
+            labels=labels.cpu().numpy(),
+            **{
+                key: np.array([config[key] for config in configs])
+                for key in ("checkpoint", "arch", "ber", "position", "seed")
+            },
+            **{
+                name: np.array(
+                    [model_metrics[name] for model_metrics in metrics]
+                )
+                for name in metrics[0]
+            },
+        )
+    print("Results saved to", results_path)
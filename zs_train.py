@@ -20,7 +20,14 @@ import torch.optim as optim
 from torch import nn
 
 from config import cfg
-from models import default_model_path, init_models_faulty
+from faultmodels.faultpool import FaultMapPool
+from models import (
+    compile_model,
+    default_model_path,
+    init_models_faulty,
+    memory_format,
+)
+from zs_metrics import RunningMetrics
 
 __all__ = ["training"]
 
@@ -64,22 +71,54 @@ def training(
     print("Training with Learning rate %.4f" % (cfg.learning_rate))
     opt = optim.SGD(model.parameters(), lr=cfg.learning_rate, momentum=0.9)
 
-    model = model.to(device)
+    mformat = memory_format()
+    model = model.to(device, memory_format=mformat)
     # model = torch.nn.DataParallel(model)
     torch.backends.cudnn.benchmark = True
 
+    pool = None
+    if cfg.fault_pool_size > 0 and fl:
+        pool = FaultMapPool(
+            cfg.fault_pool_bers or [ber],
+            cfg.fault_pool_size,
+            precision,
+            pos,
+            device,
+            seed=cfg.seed,
+        )
+        pool.attach(model)
+
+    # Checkpoints are always saved from the (uncompiled) model
+    model_fwd = model
+    if cfg.compile:
+        model_fwd = compile_model(model, cfg.compile_cache_dir)
+
     for x in range(checkpoint_epoch + 1, cfg.epochs):
 
         print("Epoch: %03d" % x)
 
-        running_loss = 0.0
-        running_correct = 0
+        epochs_done = x - (checkpoint_epoch + 1)
+        if (
+            pool is not None
+            and cfg.fault_pool_refresh > 0
+            and epochs_done > 0
+            and epochs_done % cfg.fault_pool_refresh == 0
+        ):
+            pool.generate(cfg.seed + 2 * cfg.fault_pool_size * epochs_done)
+
+        metrics = RunningMetrics(device, log_every=cfg.log_every)
         for batch_id, (inputs, outputs) in enumerate(trainloader):
-            inputs = inputs.to(device)
-            outputs = outputs.to(device)
+            inputs = inputs.to(
+                device, memory_format=mformat, non_blocking=True
+            )
+            outputs = outputs.to(device, non_blocking=True)
 
             opt.zero_grad()
 
+            # Train against a different fault map every batch
+            if pool is not None:
+                pool.sample()
+
             # Store original model parameters before
             # quantization/perturbation, detached from graph
             if precision > 0:
@@ -95,7 +134,7 @@ def training(
                         print(model.conv1.weight[0, 0, :, :])
 
             model.train()
-            model_outputs = model(inputs)  # pylint: disable=E1102
+            model_outputs = model_fwd(inputs)  # pylint: disable=E1102
 
             _, preds = torch.max(model_outputs, 1)
             outputs = outputs.view(
@@ -129,13 +168,15 @@ def training(
             # update restored weights with gradient
             opt.step()
 
-            running_loss += loss.item()
-            running_correct += torch.sum(preds == outputs.data)
+            metrics.update(
+                inputs.size(0), loss, torch.sum(preds == outputs.data)
+            )
 
-        accuracy = running_correct.double() / (len(trainloader.dataset))
+        running_loss, running_correct = metrics.values()
+        accuracy = running_correct / (len(trainloader.dataset))
         print(
             "For epoch: {}, loss: {:.6f}, accuracy: {:.5f}".format(
-                x, running_loss / len(trainloader.dataset), accuracy
+                x, running_loss / metrics.batches, accuracy
             )
         )
         if True:
@@ -156,7 +197,7 @@ def training(
                     "epoch": x,
                     "model_state_dict": model.state_dict(),
                     "optimizer_state_dict": opt.state_dict(),
-                    "loss": running_loss / batch_id,
+                    "loss": running_loss / metrics.batches,
                     "accuracy": accuracy,
                 },
                 model_path,
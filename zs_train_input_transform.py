@@ -17,7 +17,8 @@ import torch.nn as nn
 from torch.nn.parameter import Parameter
 
 from config import cfg
-from models import init_models_pairs
+from models import compile_model, init_models_pairs, memory_format
+from zs_metrics import RunningMetrics
 
 torch.manual_seed(0)
 device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -64,40 +65,46 @@ def compute_loss(model_outputs, labels):
 def accuracy_checking(
     model_orig, model_p, trainloader, testloader, pg, device
 ):
+    mformat = memory_format()
     # For training data first:
     total_train = 0
     total_test = 0
-    correct_orig_train = 0
-    correct_p_train = 0
-    correct_orig_test = 0
-    correct_p_test = 0
+    # Correct counts are kept on device and read back once per data set
+    correct_orig_train = torch.zeros((), dtype=torch.long, device=device)
+    correct_p_train = torch.zeros((), dtype=torch.long, device=device)
+    correct_orig_test = torch.zeros((), dtype=torch.long, device=device)
+    correct_p_test = torch.zeros((), dtype=torch.long, device=device)
     for x, y in trainloader:
         total_train += 1
-        x, y = x.to(device), y.to(device)
+        x = x.to(device, memory_format=mformat, non_blocking=True)
+        y = y.to(device, non_blocking=True)
         x_adv = pg(x)
         out_orig = model_orig(x_adv)
         out_p = model_p(x_adv)
         _, pred_orig = out_orig.max(1)
         _, pred_p = out_p.max(1)
         y = y.view(y.size(0))
-        correct_orig_train += torch.sum(pred_orig == y.data).item()
-        correct_p_train += torch.sum(pred_p == y.data).item()
-    accuracy_orig_train = correct_orig_train / (len(trainloader.dataset))
-    accuracy_p_train = correct_p_train / (len(trainloader.dataset))
+        correct_orig_train += torch.sum(pred_orig == y.data)
+        correct_p_train += torch.sum(pred_p == y.data)
+    accuracy_orig_train = correct_orig_train.item() / (
+        len(trainloader.dataset)
+    )
+    accuracy_p_train = correct_p_train.item() / (len(trainloader.dataset))
 
     for x, y in testloader:
         total_test += 1
-        x, y = x.to(device), y.to(device)
+        x = x.to(device, memory_format=mformat, non_blocking=True)
+        y = y.to(device, non_blocking=True)
         x_adv = pg(x)
         out_orig = model_orig(x_adv)
         out_p = model_p(x_adv)
         _, pred_orig = out_orig.max(1)
         _, pred_p = out_p.max(1)
         y = y.view(y.size(0))
-        correct_orig_test += torch.sum(pred_orig == y.data).item()
-        correct_p_test += torch.sum(pred_p == y.data).item()
-    accuracy_orig_test = correct_orig_test / (len(testloader.dataset))
-    accuracy_p_test = correct_p_test / (len(testloader.dataset))
+        correct_orig_test += torch.sum(pred_orig == y.data)
+        correct_p_test += torch.sum(pred_p == y.data)
+    accuracy_orig_test = correct_orig_test.item() / (len(testloader.dataset))
+    accuracy_p_test = correct_p_test.item() / (len(testloader.dataset))
 
     print(
         "Accuracy of training data: clean model:"
@@ -159,14 +166,16 @@ def transform_train(
         ber,
         pos,
         seed=seed,
+        model_only=True,
     )
 
     assert checkpoint_epoch == checkpoint_epoch_perturbed
 
     Pg = Program(cfg)
+    mformat = memory_format()
     model, model_perturbed, Pg = (
-        model.to(device),
-        model_perturbed.to(device),
+        model.to(device, memory_format=mformat),
+        model_perturbed.to(device, memory_format=mformat),
         Pg.to(device),
     )
 
@@ -174,6 +183,10 @@ def transform_train(
     model_perturbed.eval()
     Pg.train()
 
+    if cfg.compile:
+        model = compile_model(model, cfg.compile_cache_dir)
+        model_perturbed = compile_model(model_perturbed, cfg.compile_cache_dir)
+
     optimizer = torch.optim.Adam(
         filter(lambda p: p.requires_grad, Pg.parameters()),
         lr=cfg.learning_rate,
@@ -201,13 +214,14 @@ def transform_train(
         " of the input transform =========="
     )
     for epoch in range(cfg.epochs):
-        running_loss = 0
-        running_correct_orig = 0
-        running_correct_p = 0
-        total = 0
+        metrics = RunningMetrics(
+            device,
+            ("accuracy clean", "accuracy perturbed"),
+            log_every=cfg.log_every,
+        )
         for batch_id, (image, label) in enumerate(trainloader):
-            total += 1
-            image, label = image.to(device), label.to(device)
+            image = image.to(device, memory_format=mformat, non_blocking=True)
+            label = label.to(device, non_blocking=True)
             image_adv = Pg(image)  # pylint: disable=E1102
             out = model(image_adv)  # pylint: disable=E1102
             out_biterror = model_perturbed(image_adv)  # pylint: disable=E1102
@@ -220,17 +234,25 @@ def transform_train(
             loss.backward()
             optimizer.step()
             lr_scheduler.step()
-            running_loss += loss.item()
-            running_correct_orig += torch.sum(pred_orig == label.data).item()
-            running_correct_p += torch.sum(pred_p == label.data).item()
+            metrics.update(
+                image.size(0),
+                loss,
+                torch.sum(pred_orig == label.data),
+                torch.sum(pred_p == label.data),
+            )
 
+        (
+            running_loss,
+            running_correct_orig,
+            running_correct_p,
+        ) = metrics.values()
         accuracy_orig = running_correct_orig / (len(trainloader.dataset))
         accuracy_p = running_correct_p / (len(trainloader.dataset))
         print(
             "For epoch: {}, loss: {:.6f}, accuracy for clean model:"
             "{:.5f}, accuracy for perturbed model: {:.5f}".format(
                 epoch + 1,
-                running_loss / len(trainloader.dataset),
+                running_loss / metrics.batches,
                 accuracy_orig,
                 accuracy_p,
             )